@@ -29,11 +29,40 @@
 __revision__ = "r"+"$Revision$"[11:-2]
 __all__ = [ 'AptRepoClient', 'AptRepoException' ]
 
-from minideblib.DpkgControl import DpkgParagraph
+from minideblib.DpkgControl import DpkgParagraph, DpkgCompactParagraph
 from minideblib.DpkgDatalist import DpkgOrderedDatalist
+from minideblib.DpkgRelation import parse_relations, DpkgRelationException
 from minideblib.DpkgVersion import DpkgVersion, VersionError
 from minideblib.LoggableObject import LoggableObject
-import re, urllib2, types, time, posixpath
+from minideblib.SafeWriteFile import SafeWriteFile
+from minideblib.SignedFile import SignedFile
+import re, os, errno, urllib2, urlparse, types, time, posixpath, tempfile, cPickle, gc
+import mmap, cStringIO
+import zlib, bz2
+import threading
+
+try:
+    import hashlib
+    md5 = hashlib.md5
+except ImportError:
+    hashlib = None
+    from md5 import new as md5
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Version of save_snapshot() file format
+SNAPSHOT_FORMAT = 4
 
 try:
     set()
@@ -41,25 +70,687 @@ except NameError:
     from sets import Set as set
 
 
-def _universal_urlopen(url):
-    """More robust urlopen. It understands gzip transfer encoding"""
+class _HTTPCache:
+    """
+        On-disk cache of fetched files. Every file is stored together with
+        its ETag/Last-Modified validators, which are sent back on next fetch
+        as If-None-Match/If-Modified-Since. On "304 Not Modified" the local 
+        copy is used.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError, err:
+                # Created concurrently by another worker
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, url):
+        """Return path to cached copy of url"""
+        return os.path.join(self.cache_dir, md5(url).hexdigest())
+
+    def get_meta(self, url):
+        """Return stored validators of url as DpkgParagraph or None if url is not cached"""
+        path = self._path(url)
+        if not os.path.isfile(path) or not os.path.isfile(path + ".meta"):
+            return None
+        meta = DpkgParagraph()
+        mfl = open(path + ".meta")
+        try:
+            meta.load(mfl)
+        finally:
+            mfl.close()
+        if meta.get("url") != url:
+            return None
+        return meta
+
+    def get_validators(self, url):
+        """Return headers for conditional request of url"""
+        headers = {}
+        meta = self.get_meta(url)
+        if meta:
+            if meta.get("etag"):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get("last-modified"):
+                headers['If-Modified-Since'] = meta['last-modified']
+        return headers
+
+    def open(self, url):
+        """Return (file, headers) of cached copy of url"""
+        return (open(self._path(url), "rb"), self.get_meta(url))
+
+    def store(self, url, usock):
+        """
+            Returns (file, headers), where file reads usock response and at
+            the same time saves it to cache. Cache entry is updated only when
+            the whole response was read. Responses without validators are not cached.
+        """
+        etag = usock.headers.get('etag')
+        last_modified = usock.headers.get('last-modified')
+        if not etag and not last_modified:
+            self.remove(url)
+            return (usock, usock.headers)
+        meta = DpkgParagraph()
+        meta['url'] = url
+        for header in ('etag', 'last-modified', 'content-length', 'content-encoding'):
+            if usock.headers.get(header):
+                meta[header] = usock.headers.get(header)
+        (tmpfd, tmpname) = tempfile.mkstemp(dir = self.cache_dir)
+        return (_CacheWriter(usock, os.fdopen(tmpfd, "wb"), tmpname, self._path(url), meta), usock.headers)
+
+    def index_path(self, url):
+        """Return path to local uncompressed copy of index url, used for applying pdiffs"""
+        return self._path(url) + ".index"
+
+    def keep_index(self, url, stream):
+        """Returns file-like object, which reads stream and saves it as local copy of index url"""
+        (tmpfd, tmpname) = tempfile.mkstemp(dir = self.cache_dir)
+        return _CacheWriter(stream, os.fdopen(tmpfd, "wb"), tmpname, self.index_path(url), None)
+
+    def remove(self, url):
+        """Drop cached copy of url"""
+        path = self._path(url)
+        for name in (path, path + ".meta"):
+            if os.path.exists(name):
+                os.unlink(name)
+
+
+class _CacheWriter:
+    """
+        File-like object, which copies everything read from stream to 
+        temporary file. If stream was read till the end, its size matches
+        Content-Length stored in meta and it was verified (see verified), 
+        on close() temporary file is renamed to path and meta (if not None)
+        is saved next to it. Otherwise previous copy is dropped too.
+    """
+    def __init__(self, stream, tmpfl, tmpname, path, meta):
+        self.stream = stream
+        self.tmpfl = tmpfl
+        self.tmpname = tmpname
+        self.path = path
+        self.meta = meta
+        self.complete = False
+        self.length = 0
+        # Set to False by reader, which verifies data, until it's done
+        self.verified = True
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        if data:
+            self.tmpfl.write(data)
+            self.length += len(data)
+        if not data or not args or args[0] < 0:
+            self.complete = True
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        if data:
+            self.tmpfl.write(data)
+            self.length += len(data)
+        else:
+            self.complete = True
+        return data
+
+    def __valid(self):
+        """Checks whether the whole stream was read and verified"""
+        if not self.complete or not self.verified:
+            return False
+        if self.meta is not None and self.meta.get("content-length"):
+            try:
+                return int(self.meta["content-length"]) == self.length
+            except ValueError:
+                return False
+        return True
+
+    def close(self):
+        self.stream.close()
+        self.tmpfl.close()
+        if not self.__valid():
+            os.unlink(self.tmpname)
+            if self.complete:
+                # Truncated or corrupted file
+                for name in (self.path, self.path + ".meta"):
+                    if os.path.exists(name):
+                        os.unlink(name)
+            return
+        try:
+            if self.meta is None:
+                os.rename(self.tmpname, self.path)
+                return
+            mfl = SafeWriteFile(self.path + ".meta.new", self.path + ".meta", "w")
+            self.meta._store(mfl)
+            os.rename(self.tmpname, self.path)
+            mfl.close()
+        except:
+            if os.path.exists(self.tmpname):
+                os.unlink(self.tmpname)
+            raise
+
+
+# Factories of streaming decompressors for compressed indices
+_DECOMPRESSORS = { ".gz": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+                   ".bz2": bz2.BZ2Decompressor }
+if lzma:
+    _DECOMPRESSORS[".xz"] = lzma.LZMADecompressor
+
+# Default order in which compressed variants of indices are tried. 
+# "" means uncompressed index.
+DEFAULT_COMPRESSIONS = [ext for ext in (".xz", ".bz2", ".gz") if ext in _DECOMPRESSORS] + [""]
+
+# Size of chunks read from network
+_CHUNK_SIZE = 65536
+
+# Minimal size of index part parsed by one process in sharded mode
+_MIN_SHARD_SIZE = 1 << 20
+
+# Parser and allowed architectures of sharded parsing worker process
+_shard_settings = None
+
+def _init_shard_worker(parser, allowed_arches):
+    """Initializer of sharded parsing worker process"""
+    global _shard_settings
+    _shard_settings = (parser, allowed_arches)
+
+def _arch_allowed(architecture, allowed_arches):
+    """Checks if package for architecture should be loaded"""
+    return architecture in [ "all", "any" ] or \
+            not allowed_arches or allowed_arches == [ "all" ] or \
+            [arch for arch in architecture.split() if arch in allowed_arches]
+
+def _parse_shard(text):
+    """
+        Parses part of index in worker process. To keep pickling cheap, result
+        is tuple of: list of keys tuples, position of keys tuple for every 
+        package, positions of multiline values and all values joined by NUL 
+        (lines of multiline values are joined by newline). Changes of 
+        trueFieldCasing are returned too.
+    """
+    (parser, allowed_arches) = _shard_settings
+    casing = parser.trueFieldCasing.copy()
+    schemas = []
+    # keys -> (position in schemas, position of Architecture or None)
+    known = {}
+    sids = []
+    multiline = []
+    values = []
+    for (keys, para) in parser.iterParse(cStringIO.StringIO(text), _CHUNK_SIZE):
+        keys = tuple(keys)
+        try:
+            (sid, arch_pos) = known[keys]
+        except KeyError:
+            arch_pos = None
+            if 'architecture' in keys:
+                arch_pos = keys.index('architecture')
+            (sid, arch_pos) = known[keys] = (len(schemas), arch_pos)
+            schemas.append(keys)
+        if arch_pos is not None and not _arch_allowed(para[arch_pos], allowed_arches):
+            continue
+        sids.append(sid)
+        for value in para:
+            if type(value) is list:
+                multiline.append(len(values))
+                value = '\n'.join(value)
+            values.append(value)
+    changed = dict([(key, value) for (key, value) in parser.trueFieldCasing.items() if casing.get(key) != value])
+    return (schemas, sids, multiline, '\0'.join(values), changed)
+
+def _split_shards(data, count):
+    """Splits index text to at most count parts on paragraph boundaries"""
+    shards = []
+    start = 0
+    size = len(data) / count
+    while len(shards) < count - 1:
+        end = data.find('\n\n', start + size)
+        if end < 0:
+            break
+        shards.append(data[start:end + 2])
+        start = end + 2
+    shards.append(data[start:])
+    return shards
+
+
+class _Response:
+    """
+        File-like object with fetched data, which also keeps response headers.
+        If decompressor is specified, data is decompressed chunk by chunk
+        while it is read, so only small part of it is kept in memory.
+    """
+    def __init__(self, fileobj, headers, decompressor = None):
+        self.fileobj = fileobj
+        self.headers = headers
+        self.__decompressor = decompressor
+        if decompressor:
+            self.__decomp = decompressor()
+        self.__buf = ""
+        self.__pos = 0
+        self.__eof = False
+
+    def __fill(self):
+        """Decompresses next chunk of data into buffer. Returns False at the end of data"""
+        while not self.__eof:
+            data = self.fileobj.read(_CHUNK_SIZE)
+            if data:
+                try:
+                    data = self.__decomp.decompress(data)
+                except EOFError:
+                    # Previous stream ended exactly at the end of chunk (bz2, xz)
+                    self.__decomp = self.__decompressor()
+                    data = self.__decomp.decompress(data)
+                # Concatenated compressed streams (e.g. multi-member gzip)
+                while getattr(self.__decomp, "unused_data", None):
+                    unused = self.__decomp.unused_data
+                    self.__decomp = self.__decompressor()
+                    data += self.__decomp.decompress(unused)
+            else:
+                self.__eof = True
+                if hasattr(self.__decomp, "flush"):
+                    data = self.__decomp.flush()
+            if data:
+                self.__buf = self.__buf[self.__pos:] + data
+                self.__pos = 0
+                return True
+        return False
+
+    def read(self, size = -1):
+        if not self.__decompressor:
+            return self.fileobj.read(size)
+        while size < 0 or len(self.__buf) - self.__pos < size:
+            if not self.__fill():
+                break
+        if size < 0:
+            end = len(self.__buf)
+        else:
+            end = self.__pos + size
+        data = self.__buf[self.__pos:end]
+        self.__pos = end
+        return data
+
+    def readline(self):
+        if not self.__decompressor:
+            return self.fileobj.readline()
+        while 1:
+            idx = self.__buf.find("\n", self.__pos)
+            if idx >= 0:
+                line = self.__buf[self.__pos:idx + 1]
+                self.__pos = idx + 1
+                return line
+            if not self.__fill():
+                line = self.__buf[self.__pos:]
+                self.__buf = ""
+                self.__pos = 0
+                return line
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _response_validators(headers):
+    """Return tuple of values, which identify version of fetched file"""
+    return (headers.get('etag'), headers.get('last-modified'), headers.get('content-length'))
+
+
+def _url_unchanged(url, validators):
+    """
+        Checks with conditional request whether url still has the same 
+        validators. validators None means url was not available.
+    """
+    headers = { 'User-Agent': 'Mozilla/4.0 (compatible; Python/AptRepoClient)' }
+    if validators:
+        if validators[0]:
+            headers['If-None-Match'] = validators[0]
+        if validators[1]:
+            headers['If-Modified-Since'] = validators[1]
+    try:
+        usock = urllib2.urlopen(urllib2.Request(url, None, headers))
+    except urllib2.HTTPError, hte:
+        return (validators and hte.code == 304) or (not validators and hte.code == 404)
+    except Exception:
+        return not validators and urlparse.urlsplit(url)[0] == "file"
+    try:
+        return validators is not None and validators != (None, None, None) and \
+                _response_validators(usock.headers) == validators
+    finally:
+        usock.close()
+
+
+class _ChecksumReader:
+    """
+        File-like object, which calculates checksum of data read from stream.
+        At the end of stream checksum and size are compared with expected
+        ones and AptRepoException is raised on mismatch.
+    """
+    def __init__(self, stream, url, checksum, callback = None):
+        """callback - function called with result of verification before it's reported"""
+        self.stream = stream
+        self.url = url
+        (algo, self.expected, self.size) = checksum
+        self.hash = hashlib.new(algo)
+        self.length = 0
+        self.verified = False
+        self.callback = callback
+
+    def __update(self, data, at_end):
+        if data:
+            self.hash.update(data)
+            self.length += len(data)
+        if at_end and not self.verified:
+            self.verified = True
+            valid = self.length == self.size and self.hash.hexdigest() == self.expected
+            if self.callback:
+                self.callback(valid)
+            if not valid:
+                raise AptRepoException("Checksum mismatch for %s" % self.url)
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.__update(data, not data or not args or args[0] < 0)
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.__update(data, not data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+# Fields of Release file with checksums in order of preference and
+# corresponding hashlib algorithms
+_CHECKSUM_FIELDS = (("sha256", "sha256"), ("sha1", "sha1"), ("md5sum", "md5"))
+
+
+def _parse_release(fileobj):
+    """
+        Parses (In)Release file and returns dictionary with checksums of files
+        listed in it: { "main/binary-i386/Packages.gz": (algo, hexdigest, size), ... }
+        The strongest available checksum is used.
+    """
+    release = DpkgParagraph()
+    release.load(SignedFile(fileobj))
+    files = {}
+    if not hashlib:
+        return files
+    for (field, algo) in _CHECKSUM_FIELDS:
+        if field not in release:
+            continue
+        lines = release[field]
+        if not isinstance(lines, types.ListType):
+            lines = [lines]
+        for line in lines:
+            items = line.split()
+            if len(items) == 3:
+                files[items[2]] = (algo, items[0].lower(), int(items[1]))
+        return files
+    return files
+
+
+def _parse_diff_index(fileobj):
+    """
+        Parses Packages.diff/Index file. Returns tuple (algo, current, history, patches), 
+        where current is (hexdigest, size) of current index, history is list
+        of (hexdigest, size, patch name) of previous versions of index and 
+        patches maps patch name to checksum (algo, hexdigest, size) of compressed patch.
+        Returns None if no supported checksums found.
+    """
+    index = DpkgParagraph()
+    index.load(fileobj)
+    if not hashlib:
+        return None
+    for (field, algo) in _CHECKSUM_FIELDS:
+        field = field.replace("md5sum", "md5")
+        if field + "-current" not in index or field + "-history" not in index:
+            continue
+        items = index[field + "-current"].split()
+        current = (items[0].lower(), int(items[1]))
+        history = []
+        for line in index[field + "-history"]:
+            items = line.split()
+            if len(items) == 3:
+                history.append((items[0].lower(), int(items[1]), items[2]))
+        patches = {}
+        for line in index.get(field + "-download", []):
+            items = line.split()
+            if len(items) == 3 and items[2].endswith(".gz"):
+                patches[items[2][:-3]] = (algo, items[0].lower(), int(items[1]))
+        return (algo, current, history, patches)
+    return None
+
+
+_ED_COMMAND = re.compile(r"^(\d+)(?:,(\d+))?([acd])$")
+
+
+def _apply_ed_patch(lines, patch):
+    """
+        Applies ed-style patch (as produced by diff --ed) read from patch 
+        file-like object to list of lines. Raises AptRepoException on 
+        unsupported commands.
+    """
+    while 1:
+        command = patch.readline()
+        if not command:
+            break
+        match = _ED_COMMAND.match(command.rstrip("\n"))
+        if not match:
+            raise AptRepoException("Unsupported command in patch: %s" % command.rstrip("\n"))
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        text = []
+        if match.group(3) in "ac":
+            while 1:
+                line = patch.readline()
+                if not line:
+                    raise AptRepoException("Unexpected end of patch")
+                if line == ".\n":
+                    break
+                text.append(line)
+        if match.group(3) == "a":
+            lines[start:start] = text
+        elif match.group(3) == "c":
+            lines[start-1:end] = text
+        else:
+            del lines[start-1:end]
+
+
+def _split_paragraphs(lines):
+    """Splits list of lines of index to list of paragraphs texts"""
+    paragraphs = []
+    current = []
+    for line in lines:
+        if line == "\n":
+            if current:
+                paragraphs.append("".join(current))
+                current = []
+        else:
+            current.append(line)
+    if current:
+        paragraphs.append("".join(current))
+    return paragraphs
+
+
+def _cache_verifier(cache, url, writer):
+    """
+        Return callback for _ChecksumReader, which lets writer (if not None)
+        save fetched url to cache only when checksum matches. Cached copy,
+        which doesn't match, is dropped.
+    """
+    if writer:
+        writer.verified = False
+    def verified(valid):
+        if writer:
+            writer.verified = valid
+        if not valid:
+            cache.remove(url)
+    return verified
+
+def _universal_urlopen(url, cache_dir = None, checksum = None):
+    """
+        More robust urlopen. It understands gzip transfer encoding.
+        If cache_dir is specified, response is cached there and 
+        revalidated by conditional GET on next requests.
+        If checksum (algo, hexdigest, size) is specified, fetched file is 
+        verified while it's read.
+        Returned object has "headers" attribute with response headers.
+    """
     headers = { 'User-Agent': 'Mozilla/4.0 (compatible; Python/AptRepoClient)',
                 'Pragma': 'no-cache',
                 'Cache-Control': 'no-cache',
                 'Accept-encoding': 'gzip' }
+    cache = None
+    writer = None
+    if cache_dir and urlparse.urlsplit(url)[0] in ("http", "https"):
+        cache = _HTTPCache(cache_dir)
+        headers.update(cache.get_validators(url))
     request = urllib2.Request(url, None, headers)
-    usock = urllib2.urlopen(request)
-    if usock.headers.get('content-encoding', None) == 'gzip' or url.endswith(".gz"):
-        data = usock.read()
-        import cStringIO, gzip
-        data = gzip.GzipFile(fileobj = cStringIO.StringIO(data)).read()
-        return cStringIO.StringIO(data)
+    try:
+        usock = urllib2.urlopen(request)
+    except urllib2.HTTPError, hte:
+        if hte.code == 304 and cache and cache.get_meta(url):
+            (usock, headers) = cache.open(url)
+        else:
+            raise
     else:
-        return usock
+        if cache:
+            (usock, headers) = cache.store(url, usock)
+            if isinstance(usock, _CacheWriter):
+                writer = usock
+        else:
+            headers = usock.headers
+    transfer_gzip = headers.get('content-encoding', None) == 'gzip'
+    if transfer_gzip:
+        usock = _Response(usock, headers, _DECOMPRESSORS[".gz"])
+    if checksum:
+        if transfer_gzip and url.endswith(".gz"):
+            # Broken server sent .gz file with gzip transfer encoding,
+            # we can't verify it
+            pass
+        else:
+            callback = None
+            if cache:
+                callback = _cache_verifier(cache, url, writer)
+            usock = _ChecksumReader(usock, url, checksum, callback)
+    for (ext, decompressor) in _DECOMPRESSORS.items():
+        if url.endswith(ext):
+            if ext == ".gz" and transfer_gzip:
+                # Already decompressed
+                break
+            return _Response(usock, headers, decompressor)
+    return _Response(usock, headers)
+
+
+def _is_not_found(exc):
+    """Checks if exception raised by urlopen means that requested file doesn't exist"""
+    if isinstance(exc, urllib2.HTTPError):
+        return exc.code == 404
+    if isinstance(exc, urllib2.URLError):
+        return getattr(exc.reason, "errno", None) == errno.ENOENT
+    return False
+
 
+def _make_package_filter(spec):
+    """
+        Converts package filter specification to function, which takes package
+        name and returns true if package should be loaded. spec can be a name,
+        set (or other container) of names, list or tuple of name prefixes, 
+        compiled regular expression (matched at the beginning of name) or function.
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, basestring):
+        return lambda name: name == spec
+    if isinstance(spec, (types.ListType, types.TupleType)):
+        if not spec:
+            return lambda name: False
+        return re.compile("|".join([re.escape(prefix) for prefix in spec])).match
+    if hasattr(spec, "match") and hasattr(spec, "pattern"):
+        return spec.match
+    if callable(spec):
+        return spec
+    return spec.__contains__
+
+
+def _package_filter_key(spec):
+    """
+        Returns picklable value, which identifies package filter specification.
+        None is returned for functions, which can't be compared.
+    """
+    if spec is None:
+        return ()
+    if isinstance(spec, basestring):
+        return ("names", spec)
+    if isinstance(spec, (types.ListType, types.TupleType)):
+        return ("prefixes",) + tuple(spec)
+    if hasattr(spec, "match") and hasattr(spec, "pattern"):
+        return ("regex", spec.pattern, spec.flags)
+    if callable(spec):
+        return None
+    names = list(spec)
+    names.sort()
+    return ("names",) + tuple(names)
+
+
+def _share_paragraphs(container, pool):
+    """
+        Replaces Architecture: all paragraphs of container by equal ones from
+        pool, so package repeated in every per-architecture index is kept in 
+        memory once. Paragraphs not found in pool are added to it.
+    """
+    for name in container.keys():
+        paras = container[name]
+        for idx in range(len(paras)):
+            para = paras[idx]
+            # Lazy paragraphs keep their text in mmapped file anyway
+            if isinstance(para, LazyAptRepoParagraph) or para.get('architecture') != 'all':
+                continue
+            checksum = para.get('sha256') or para.get('md5sum')
+            if not checksum:
+                continue
+            shared = pool.setdefault((para.base_url, name, para.get('version'), checksum), para)
+            if shared is not para and shared.items() == para.items():
+                paras[idx] = shared
 
-def _filter_base_urls(base_url, pkgcache):
-    """Return list of keys to be used in pkgcache lookup according to requested base_keys"""
+
+class _RepoKeyIndex:
+    """
+        Index of pkgcache keys (url, distribution, section) by all 
+        combinations of their elements with None wildcards. 
+        Results of filtering are memoized.
+    """
+    def __init__(self, pkgcache):
+        self.keys = pkgcache.keys()
+        self.index = {}
+        for key in self.keys:
+            for mask in range(8):
+                wkey = list(key)
+                for pos in range(3):
+                    if mask & (1 << pos):
+                        wkey[pos] = None
+                self.index.setdefault(tuple(wkey), set()).add(key)
+        self.memo = {}
+
+    def filter(self, cache_keys):
+        """Return list of keys matching any of cache_keys. Order of keys is preserved"""
+        cache_keys = tuple(cache_keys)
+        try:
+            return self.memo[cache_keys]
+        except KeyError:
+            pass
+        matched = set()
+        for ckey in cache_keys:
+            matched.update(self.index.get(ckey, ()))
+        result = [key for key in self.keys if key in matched]
+        self.memo[cache_keys] = result
+        return result
+
+
+def _filter_base_urls(base_url, pkgcache, key_index = None):
+    """
+        Return list of keys to be used in pkgcache lookup according to requested base_keys.
+        If key_index (_RepoKeyIndex of pkgcache) is given, it's used instead of scanning all keys.
+    """
     if base_url:
         if isinstance(base_url, types.ListType):
             cache_keys = base_url
@@ -70,21 +761,24 @@ def _filter_base_urls(base_url, pkgcache):
         else:
             # WTF!?
             raise TypeError("Parameter base_url should be array of strings or string or tuple")
+        for ckey in cache_keys:
+            if not isinstance(ckey, types.TupleType) and len(ckey) != 3:
+                raise TypeError("base_url key should be a tuple -> (url, distribution, section): %s" % str(ckey))
+        if key_index is not None:
+            return key_index.filter([tuple(ckey) for ckey in cache_keys])
         # Ok, we have list of keys, let's compare them
         rkeys = set()
         pckeys = pkgcache.keys()
         for ckey in cache_keys:
-            if not isinstance(ckey, types.TupleType) and len(ckey) != 3:
-                raise TypeError("base_url key should be a tuple -> (url, distribution, section): %s" % str(ckey))
             rkeys.update([akey for akey in pckeys if (ckey[0] is None or ckey[0] == akey[0]) and (ckey[1] is None or ckey[1] == akey[1]) and (ckey[2] is None or ckey[2] == akey[2])])
         return list(rkeys) 
     else:
         return pkgcache.keys()
 
 
-def _get_available_pkgs(base_url, pkgcache):
+def _get_available_pkgs(base_url, pkgcache, key_index = None):
     """Returns list of package names, available in pkgcache filtered by base_url"""
-    cache_keys = _filter_base_urls(base_url, pkgcache)
+    cache_keys = _filter_base_urls(base_url, pkgcache, key_index)
     pkg_names = set()
     for cache_key in cache_keys:
         pkgs = pkgcache.get(cache_key, {})
@@ -92,12 +786,12 @@ def _get_available_pkgs(base_url, pkgcache):
     return list(pkg_names)
 
 
-def _get_available_versions(package, base_url, pkgcache):
+def _get_available_versions(package, base_url, pkgcache, key_index = None):
     """
         Should return touple (base_url,package_version) with the best version found in cache.
         If base_url is not specified, all repositories will be checked
     """
-    cache_keys = _filter_base_urls(base_url, pkgcache)
+    cache_keys = _filter_base_urls(base_url, pkgcache, key_index)
 
     pkg_vers = [] 
     for cache_key in cache_keys:
@@ -123,13 +817,16 @@ class AptRepoException(Exception):
 
 class AptRepoParagraph(DpkgParagraph):
     """Like DpkgParagraph, but can return urls to packages and can return correct source package name/version for binaries"""
+    _relations = None
+
     def __init__(self, fname = "", base_url = None):
         DpkgParagraph.__init__(self, fname)
         self.base_url = base_url
-        self.__files = None
-        self.__urls = None
-        self.__pkgid = None
-        self.__source_version = None
+        self._files = None
+        self._urls = None
+        self._pkgid = None
+        self._source_version = None
+        self._relations = None
 
     def __hash__(self):
         """Make this object hashable"""
@@ -139,24 +836,24 @@ class AptRepoParagraph(DpkgParagraph):
         """Sets base url for this package. Used later to calculate relative paths"""
         self.base_url = base_url
         # After change the base URL, cached URLs are not valid anymore
-        self.__urls = None
+        self._urls = None
 
     def get_files(self):
         """Return list of files in this package. Format similar to .changes files section"""
-        if self.__files:
-            return self.__files
+        if self._files:
+            return self._files
         try:
             files = self['files']
         except KeyError:
             # Binary package ?
             if "filename" in self:
-                self.__files = [(self['md5sum'], self['size'], None, None, self['filename'])]
-                return self.__files
+                self._files = [(self['md5sum'], self['size'], None, None, self['filename'])]
+                return self._files
             else:
                 # Something wrong
                 return []
 
-        self.__files = []
+        self._files = []
         lineregexp = re.compile( 
             "^(?P<f_md5>[0-9a-f]{32})[ \t]+(?P<f_size>\d+)" +
             "(?:[ \t]+(?P<f_section>[-/a-zA-Z0-9]+)[ \t]+(?P<f_priority>[-a-zA-Z0-9]+))?" +
@@ -169,20 +866,20 @@ class AptRepoParagraph(DpkgParagraph):
             if (match is None):
                 raise AptRepoException("Couldn't parse file entry \"%s\" in Files field of .changes" % (line,))
             else:
-                self.__files.append((match.group("f_md5"), match.group("f_size"), match.group("f_section"), match.group("f_priority"), match.group("f_name")))
-        return self.__files
+                self._files.append((match.group("f_md5"), match.group("f_size"), match.group("f_section"), match.group("f_priority"), match.group("f_name")))
+        return self._files
 
     def get_pkgid(self):
         """Return pkg id for this package. For binaries it's MD5 sum of file, for sources MD5 sum of .dsc"""
-        if self.__pkgid:
-            return self.__pkgid
+        if self._pkgid:
+            return self._pkgid
         try:
             files = self['files']
         except KeyError:
             # Binary package ?
             if "md5sum" in self:
-                self.__pkgid = self['md5sum']
-                return self.__pkgid
+                self._pkgid = self['md5sum']
+                return self._pkgid
             else:
                 # Something wrong
                 raise AptRepoException("Binary package, but MD5Sum not defined")
@@ -200,88 +897,517 @@ class AptRepoParagraph(DpkgParagraph):
                 raise AptRepoException("Couldn't parse file entry \"%s\" in Files field of .changes" % (line,))
             else:
                 if match.group("f_name").endswith(".dsc"):
-                    self.__pkgid = match.group("f_md5")
-                    return self.__pkgid
+                    self._pkgid = match.group("f_md5")
+                    return self._pkgid
         raise AptRepoException("No DSC file found in source package")
 
     def get_urls(self):
         """Return array of URLs to package files"""
 
-        if self.__urls:
-            return self.__urls
+        if self._urls:
+            return self._urls
         if "filename" in self:
-            self.__urls = [posixpath.join(self.base_url, self['filename'])]
-            return self.__urls
+            self._urls = [posixpath.join(self.base_url, self['filename'])]
+            return self._urls
         if "files" in self:
-            self.__urls = []
+            self._urls = []
             for elems in self.get_files():
-                self.__urls.append(posixpath.join(self.base_url, self['directory'], elems[4]))
-            return self.__urls
+                self._urls.append(posixpath.join(self.base_url, self['directory'], elems[4]))
+            return self._urls
 
     def get_source(self):
         """ Return tuple (name, version) for sources of this package """
-        if self.__source_version:
-            return self.__source_version
+        if self._source_version:
+            return self._source_version
         if "files" in self:
             # It's source itself, stupid people
-            self.__source_version = (self['package'], self['version'])
+            self._source_version = (self['package'], self['version'])
         # Ok, it's binary. Let's analize some situations
         elif "source" not in self:
             # source name the same as package
-            self.__source_version = (self['package'], self['version'])
+            self._source_version = (self['package'], self['version'])
         else:
             # Source: tag present. Let's deal with it
             match = re.search(r"(?P<name>[0-9a-zA-Z][-+:.,=~0-9a-zA-Z_]+)(\s+\((?P<ver>(?:[0-9]+:)?[a-zA-Z0-9.+-]+)\))?", self['source'])
             if not match.group("ver"):
-                self.__source_version = (match.group("name"), self['version'])
+                self._source_version = (match.group("name"), self['version'])
             else:
                 # mostly braindead packagers
-                self.__source_version = (match.group("name"), match.group("ver"))
-        if self.__source_version:
-            return self.__source_version
+                self._source_version = (match.group("name"), match.group("ver"))
+        if self._source_version:
+            return self._source_version
         else:
             raise AptRepoException("Something strange. We can't identify source version")
 
+    def get_relations(self, field):
+        """
+            Return parsed relationship field, e.g. "depends", as tuple of 
+            alternatives (see DpkgRelation.parse_relations). Missing field 
+            gives empty tuple. Result is computed once.
+        """
+        if self._relations is None:
+            self._relations = {}
+        try:
+            return self._relations[field]
+        except KeyError:
+            relations = self._relations[field] = parse_relations(self.get(field, ""))
+            return relations
+
+
+class CompactAptRepoParagraph(DpkgCompactParagraph):
+    """
+        AptRepoParagraph based on DpkgCompactParagraph. Used by default for 
+        packages loaded from repositories.
+    """
+    __slots__ = ('base_url', '_files', '_urls', '_pkgid', '_source_version', '_relations')
+
+    def __init__(self, keys = (), values = (), base_url = None):
+        DpkgCompactParagraph.__init__(self, keys, values)
+        self.base_url = base_url
+        self._files = None
+        self._urls = None
+        self._pkgid = None
+        self._source_version = None
+        self._relations = None
+
+    def __getstate__(self):
+        return (DpkgCompactParagraph.__getstate__(self), self.base_url)
+
+    def __setstate__(self, state):
+        DpkgCompactParagraph.__setstate__(self, state[0])
+        self.base_url = state[1]
+        self._files = None
+        self._urls = None
+        self._pkgid = None
+        self._source_version = None
+        self._relations = None
+
+    def copy(self):
+        return CompactAptRepoParagraph(self._schema.keys, self._values, self.base_url)
+
+    # Methods are shared with AptRepoParagraph
+    __hash__ = AptRepoParagraph.__dict__['__hash__']
+    set_base_url = AptRepoParagraph.__dict__['set_base_url']
+    get_files = AptRepoParagraph.__dict__['get_files']
+    get_pkgid = AptRepoParagraph.__dict__['get_pkgid']
+    get_urls = AptRepoParagraph.__dict__['get_urls']
+    get_source = AptRepoParagraph.__dict__['get_source']
+    get_relations = AptRepoParagraph.__dict__['get_relations']
+
+
+class LazyAptRepoParagraph(CompactAptRepoParagraph):
+    """
+        CompactAptRepoParagraph, which keeps only package name, version and
+        location of its text in mmapped index file. Other fields are parsed
+        on first access to them.
+    """
+    __slots__ = ('_mmap', '_offset', '_length', '_package', '_version', '_parser')
+
+    def __init__(self, mmap_obj, offset, length, package, version, base_url = None, parser = None):
+        """parser is DpkgParagraph used to parse text. It can be shared by many paragraphs"""
+        # Fields are not set: they are created by __materialize()
+        self.base_url = base_url
+        self._files = None
+        self._urls = None
+        self._pkgid = None
+        self._source_version = None
+        self._relations = None
+        self._mmap = mmap_obj
+        self._offset = offset
+        self._length = length
+        self._package = package
+        self._version = version
+        if parser is None:
+            parser = DpkgParagraph(None)
+        self._parser = parser
+
+    def __materialize(self):
+        """Parses paragraph text"""
+        text = self._mmap[self._offset:self._offset + self._length]
+        (keys, values) = self._parser.parseText(text[:-1])
+        DpkgCompactParagraph.__init__(self, keys, values)
+        self._mmap = None
+        self._parser = None
+
+    def __getattr__(self, name):
+        # Unset slots of not materialized paragraph
+        if name in ("_schema", "_values") and self._mmap is not None:
+            self.__materialize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        """mmap can't be pickled, so paragraph is pickled materialized"""
+        if self._mmap is not None:
+            self.__materialize()
+        return CompactAptRepoParagraph.__getstate__(self)
+
+    def __setstate__(self, state):
+        CompactAptRepoParagraph.__setstate__(self, state)
+        self._mmap = None
+
+    def copy(self):
+        """Return materialized copy as CompactAptRepoParagraph"""
+        if self._mmap is not None:
+            self.__materialize()
+        return CompactAptRepoParagraph.copy(self)
+
+    def is_materialized(self):
+        """Return True if paragraph fields were already parsed"""
+        return self._mmap is None
+
+    def __getitem__(self, key):
+        if self._mmap is not None:
+            if key == "package":
+                return self._package
+            elif key == "version":
+                return self._version
+        return CompactAptRepoParagraph.__getitem__(self, key)
+
+    def get(self, key, failobj = None):
+        if self._mmap is not None:
+            if key == "package":
+                return self._package
+            elif key == "version":
+                return self._version
+        return CompactAptRepoParagraph.get(self, key, failobj)
+
+    def has_key(self, key):
+        if self._mmap is not None and key in ("package", "version"):
+            return True
+        return CompactAptRepoParagraph.has_key(self, key)
+
 
 class AptRepoMetadataBase(DpkgOrderedDatalist):
-    def __init__(self, base_url = None, case_sensitive = 0, allowed_arches = None):
+    package_filter = None
+    processes = 1
+
+    def __init__(self, base_url = None, case_sensitive = 0, allowed_arches = None, lazy = False, storage_dir = None,
+                 fields = None, compact = True, processes = 1):
+        """
+            If lazy is True, loaded index is stored to file in storage_dir
+            (temporary directory by default) and mmapped. Paragraphs are 
+            LazyAptRepoParagraph objects, which parse their fields on first access.
+            If fields (list of field names) is specified, only these fields are
+            loaded. Key field and Architecture are always loaded.
+            Packages are loaded as CompactAptRepoParagraph objects, or as 
+            AptRepoParagraph if compact is False.
+            If processes is greater than 1, large indices are split on paragraph
+            boundaries and parsed by pool of processes (requires multiprocessing).
+            Without fork(), package filter should be picklable in this mode.
+        """
+        # package name -> best DpkgVersion. Cleared on every change of content
+        self._best = {}
         DpkgOrderedDatalist.__init__(self)
         self.key = "package"
         self.case_sensitive = case_sensitive
         self.base_url = base_url
         self.allowed_arches = allowed_arches
+        self.lazy = lazy
+        self.storage_dir = storage_dir
+        self.compact = compact
+        self.processes = processes
+        self.set_fields(fields)
+
+    def set_fields(self, fields):
+        """Sets list of fields to load. None means all fields"""
+        self.fields = fields
+        if fields is None:
+            self._fields = None
+        else:
+            if self.case_sensitive:
+                self._fields = set(fields)
+            else:
+                self._fields = set([field.lower() for field in fields])
+            self._fields.update(["architecture", self.key.lower()])
+
+    def set_package_filter(self, func):
+        """
+            Sets function, which is called with value of key field as soon as
+            it's read. Paragraphs, for which it returns false, are skipped
+            without parsing. None disables filtering.
+        """
+        self.package_filter = func
+
+    def __getstate__(self):
+        # Filter functions can't be pickled
+        state = self.__dict__.copy()
+        state.pop('package_filter', None)
+        return state
 
     def setkey(self, key):
         self.key = key
+        self.set_fields(self.fields)
 
     def set_case_sensitive(self, value):
         self.case_sensitive = value
+        self.set_fields(self.fields)
+
+    def __make_parser(self):
+        """Returns DpkgParagraph, which parses paragraphs with settings of this container"""
+        parser = DpkgParagraph(None)
+        parser.setCaseSensitive(self.case_sensitive)
+        parser.setFields(self._fields)
+        if self.package_filter is not None:
+            if self.case_sensitive:
+                parser.setFilter(self.key, self.package_filter)
+            else:
+                parser.setFilter(self.key.lower(), self.package_filter)
+        return parser
 
-    def __load_one(self, in_file, base_url):
-        """Load meta-information for one package"""
+    def __make_paragraph(self, keys, values, base_url):
+        """Creates paragraph for one package"""
+        if self.compact:
+            return CompactAptRepoParagraph(keys, values, base_url)
         para = AptRepoParagraph(None, base_url = base_url)
         para.setCaseSensitive(self.case_sensitive)
-        para.load( in_file )
+        para.setlists(keys, values)
         return para
 
-    def load(self, inf, base_url = None):
-        """Load packages meta-information to internal data structures"""
+    def __setitem__(self, key, value):
+        self._best = {}
+        DpkgOrderedDatalist.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._best = {}
+        DpkgOrderedDatalist.__delitem__(self, key)
+
+    def get_best_version(self, package):
+        """
+            Return the best DpkgVersion of package available in this container 
+            or None. Packages with invalid versions are ignored. Result is
+            cached until content of container is changed.
+        """
+        try:
+            return self._best[package]
+        except KeyError:
+            pass
+        best = None
+        for pkg in self.get(package, []):
+            try:
+                ver = DpkgVersion.parse(pkg['version'])
+            except VersionError:
+                continue
+            if best is None or ver > best:
+                best = ver
+        self._best[package] = best
+        return best
+
+    def _arch_allowed(self, architecture):
+        """Checks if package for architecture should be loaded"""
+        return _arch_allowed(architecture, self.allowed_arches)
+
+    def make_pool(self):
+        """
+            Return multiprocessing.Pool, which parses indices with settings
+            of this container (see load()). As any fork, it should be created
+            before threads are started.
+        """
+        size = self.processes
+        try:
+            size = min(size, multiprocessing.cpu_count())
+        except NotImplementedError:
+            pass
+        return multiprocessing.Pool(size, _init_shard_worker, (self.__make_parser(), self.allowed_arches))
+
+    def load(self, inf, base_url = None, pool = None):
+        """
+            Load packages meta-information to internal data structures.
+            pool is made by make_pool() of container with the same settings
+            and is used for sharded parsing. By default new pool is created 
+            for every large index.
+        """
         if base_url is None:
             base_url = self.base_url
-        while 1:
-            para = self.__load_one(inf, base_url)
-            if not para: 
-                break
-            
-            if 'architecture' in para and \
-                    para['architecture'] not in [ "all", "any" ] and \
-                    self.allowed_arches and self.allowed_arches != [ "all" ] and \
-                    not [arch for arch in para['architecture'].split() if arch in self.allowed_arches]:
-                continue
+        self._best = {}
+        if self.lazy and not self.case_sensitive:
+            self.__load_lazy(inf, base_url)
+            return
+        if self.processes > 1 and multiprocessing and hasattr(inf, 'read'):
+            packages = self.__iter_sharded(inf, base_url, pool)
+        else:
+            packages = self.iter_load(inf, base_url)
+        for para in packages:
             if para[self.key] not in self:
                 self[para[self.key]] = []
             self[para[self.key]].append(para)
 
+    def iter_load(self, inf, base_url = None):
+        """
+            Generator, which yields packages from inf one at a time, the same
+            as load() would store them. Container itself is not changed.
+        """
+        if base_url is None:
+            base_url = self.base_url
+        for (keys, values) in self.__make_parser().iterParse(inf, _CHUNK_SIZE):
+            para = self.__make_paragraph(keys, values, base_url)
+            if 'architecture' in para and not self._arch_allowed(para['architecture']):
+                continue
+            yield para
+
+    def __iter_sharded(self, inf, base_url, pool = None):
+        """
+            Generator, which parses index by pool of processes and yields 
+            packages in order of index, like iter_load()
+        """
+        data = inf.read()
+        count = min(self.processes, len(data) / _MIN_SHARD_SIZE)
+        try:
+            count = min(count, multiprocessing.cpu_count())
+        except NotImplementedError:
+            pass
+        # NUL separates values in results of workers
+        if count < 2 or data.find('\0') >= 0:
+            for para in self.iter_load(cStringIO.StringIO(data), base_url):
+                yield para
+            return
+        shards = _split_shards(data, count)
+        del data
+        parser = self.__make_parser()
+        if pool is not None:
+            results = pool.map(_parse_shard, shards, 1)
+        else:
+            pool = multiprocessing.Pool(len(shards), _init_shard_worker, (parser, self.allowed_arches))
+            try:
+                results = pool.map(_parse_shard, shards, 1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            pool.join()
+        del shards
+        while results:
+            (schemas, sids, multiline, values, changed) = results.pop(0)
+            parser.trueFieldCasing.update(changed)
+            values = values.split('\0')
+            for pos in multiline:
+                values[pos] = values[pos].split('\n')
+            # Restore interning lost in transfer
+            interned = []
+            for sid in range(len(schemas)):
+                keys = schemas[sid] = tuple(map(intern, schemas[sid]))
+                interned.append([pos for pos in range(len(keys)) if keys[pos] in parser.internValues])
+            start = 0
+            for sid in sids:
+                keys = schemas[sid]
+                para = values[start:start + len(keys)]
+                start += len(keys)
+                for pos in interned[sid]:
+                    para[pos] = intern(para[pos])
+                yield self.__make_paragraph(keys, para, base_url)
+
+    def __load_lazy(self, inf, base_url):
+        """
+            Copies index to local file, mmaps it and creates LazyAptRepoParagraph
+            for every paragraph. Only key, version and architecture fields are parsed.
+        """
+        (tmpfd, tmpname) = tempfile.mkstemp(dir = self.storage_dir)
+        try:
+            tmpfl = os.fdopen(tmpfd, "w+b")
+            try:
+                while 1:
+                    data = inf.read(_CHUNK_SIZE)
+                    if not data:
+                        break
+                    tmpfl.write(data)
+                tmpfl.flush()
+                if not tmpfl.tell():
+                    return
+                mmap_obj = mmap.mmap(tmpfl.fileno(), 0, access = mmap.ACCESS_READ)
+            finally:
+                tmpfl.close()
+        finally:
+            # mmapped data stays available until mmap is freed
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+        fields = ["package", "version", "architecture"]
+        if self.key not in fields:
+            fields.append(self.key)
+        field_re = re.compile(r"^(%s):(.*)$" % "|".join([re.escape(field) for field in fields]), re.M | re.I)
+        # Shared by all paragraphs to parse their text on first access
+        parser = DpkgParagraph(None)
+        parser.setFields(self._fields)
+        pos = 0
+        size = len(mmap_obj)
+        while pos < size:
+            # skip blank lines until we reach a paragraph
+            while pos < size and mmap_obj[pos] == "\n":
+                pos += 1
+            if pos >= size:
+                break
+            end = mmap_obj.find("\n\n", pos)
+            if end < 0:
+                end = size
+            else:
+                end += 1
+            head = {}
+            for (field, value) in field_re.findall(mmap_obj[pos:end]):
+                head[field.lower()] = value[1:]
+            if head:
+                if self.package_filter is not None and not self.package_filter(head[self.key]):
+                    pass
+                elif 'architecture' not in head or self._arch_allowed(head['architecture']):
+                    para = LazyAptRepoParagraph(mmap_obj, pos, end - pos, head.get("package"), head.get("version"), 
+                                                base_url, parser)
+                    if head[self.key] not in self:
+                        self[head[self.key]] = []
+                    self[head[self.key]].append(para)
+            pos = end
+
+    def _empty_copy(self):
+        """Return new empty container with the same settings"""
+        copy = AptRepoMetadataBase(self.base_url, self.case_sensitive, self.allowed_arches, self.lazy, self.storage_dir,
+                                   self.fields, self.compact, self.processes)
+        copy.setkey(self.key)
+        copy.set_package_filter(self.package_filter)
+        return copy
+
+    def merge(self, other):
+        """Append packages loaded into other container, keeping their order"""
+        self._best = {}
+        for key in other.keys():
+            if key not in self:
+                self[key] = []
+            self[key].extend(other[key])
+
+    def replace_paragraphs(self, removed, added):
+        """
+            Removes packages with the same content as ones in removed container
+            and adds packages of added container. Added package takes place of
+            removed one with the same key, so order of keys doesn't change
+            when package is updated.
+        """
+        self._best = {}
+        holes = {}
+        for key in removed.keys():
+            if key not in self:
+                continue
+            for para in removed[key]:
+                content = para.items()
+                for idx in range(len(self[key])):
+                    if idx not in holes.get(key, ()) and self[key][idx].items() == content:
+                        holes.setdefault(key, []).append(idx)
+                        break
+        for key in added.keys():
+            if key not in self:
+                self[key] = []
+            places = holes.get(key, [])
+            places.sort()
+            for para in added[key]:
+                if places:
+                    self[key][places.pop(0)] = para
+                else:
+                    self[key].append(para)
+        # Drop packages, which weren't replaced
+        for (key, places) in holes.items():
+            if places:
+                self[key] = [self[key][idx] for idx in range(len(self[key])) if idx not in places]
+                if not self[key]:
+                    del self[key]
+
     def _store(self, ofl):
         """Write our control data to a file object"""
         for key in self.keys():
@@ -292,8 +1418,32 @@ class AptRepoMetadataBase(DpkgOrderedDatalist):
 
 class AptRepoClient(LoggableObject):
     """ Client class to access Apt repositories. """
-    def __init__(self, repos = None, arch = None):
-        """Base class to access APT debian packages meta-data"""
+    def __init__(self, repos = None, arch = None, workers = 1, per_host = None, cache_dir = None, compressions = None,
+                 use_release = True, use_pdiffs = True, lazy = False, fields = None, compact = True, processes = 1):
+        """
+            Base class to access APT debian packages meta-data.
+            workers - number of indices fetched and parsed concurrently
+            per_host - max number of concurrent connections to one host (None - no limit)
+            cache_dir - directory to keep fetched indices in. Cached indices
+                        are downloaded again only if they were changed on server.
+            compressions - list of index extensions in order of preference, 
+                        e.g. [".xz", ".gz", ""]. By default DEFAULT_COMPRESSIONS
+            use_release - use checksums from InRelease/Release files to choose
+                        the smallest index variant, to verify fetched indices
+                        and to skip indices, which were not changed since 
+                        previous load.
+            use_pdiffs - if cache_dir is set and repository provides 
+                        Packages.diff/Index, update previously loaded indices 
+                        by applying patches instead of downloading them again.
+            lazy - keep indices in mmapped files and parse packages fields
+                        only when they are accessed (see LazyAptRepoParagraph).
+            fields - list of fields to load, e.g. ("package", "version", "depends").
+                        Other fields are skipped by parser. None means all fields.
+            compact - keep packages as CompactAptRepoParagraph objects, which
+                        take much less memory than AptRepoParagraph.
+            processes - number of processes, which parse one large index
+                        (see AptRepoMetadataBase). 1 disables sharded parsing.
+        """
         if arch:
             self._arch = arch
         else:
@@ -302,30 +1452,213 @@ class AptRepoClient(LoggableObject):
         self.binaries = {}
         self.source_to_binaries_map = {}
         self.pkgid_map = {}
+        self.rdepends_map = {}
+        self.provides_map = {}
+        # Made maps and fields rdepends_map was made of. Maps can be empty,
+        # they are made again when they are replaced, e.g. on reload
+        self._rdepends_made = None
+        self._rdepends_fields = None
+        self._provides_made = None
         self._repos = []
+        self._workers = max(1, workers)
+        self._per_host = per_host
+        self._cache_dir = cache_dir
+        if compressions is None:
+            compressions = DEFAULT_COMPRESSIONS
+        for ext in compressions:
+            if ext and ext not in _DECOMPRESSORS:
+                raise AptRepoException("Unsupported index compression: %s" % ext)
+        self._compressions = list(compressions)
+        self._use_release = use_release
+        self._use_pdiffs = use_pdiffs
+        self._lazy = lazy
+        self._fields = fields
+        self._compact = compact
+        self._processes = processes
+        # Pool of processes for sharded parsing, exists while indices are loaded
+        self._pool = None
+        self._package_filter = None
+        self._validators = {}
+        # url -> (extension, checksum, container) of indices loaded with known checksum
+        self._indices = {}
+        # (id(pkgcache), package) -> result of unfiltered best version lookup
+        self._best_versions = {}
+        # id(pkgcache) -> _RepoKeyIndex
+        self._key_indices = {}
+        # Incremented every time loaded packages are replaced
+        self._generation = 0
         if repos:
             self.__make_repos(repos)
 
-    def load_repos(self, repoline = None, ignore_errors = True, clear = True):
-        """Loads repositories into internal data structures. Replaces previous content if clear = True (default)"""
+    def load_repos(self, repoline = None, ignore_errors = True, clear = True, package_filter = None):
+        """
+            Loads repositories into internal data structures. Replaces previous content if clear = True (default)
+            If package_filter is specified, only matching packages are loaded. It can be 
+            a package name, set of package names, list or tuple of name prefixes, compiled
+            regular expression or function, which takes package name and returns boolean.
+        """
+        if package_filter is not self._package_filter:
+            # Indices loaded with other filter can't be reused
+            self._indices = {}
+            self._package_filter = package_filter
         if clear:
             self.sources = {}
             self.binaries = {}
             self.source_to_binaries_map = {}
             self.pkgid_map = {}
+            self._validators = {}
+        self.rdepends_map = {}
+        self.provides_map = {}
+        self._best_versions = {}
+        self._key_indices = {}
+        self._generation += 1
         if repoline:
             self.__make_repos(repoline, clear)    
 
-        self.__load_repos(self._repos, ignore_errors)
+        self.__load_repos(self._repos, ignore_errors, clear, _make_package_filter(package_filter))
 
     # Alias for load_repos(). Just to make commandline apt-get users happy
     update = load_repos
 
+    def save_snapshot(self, path):
+        """
+            Saves parsed repositories metadata to file, which can be loaded 
+            later by load_snapshot() much faster than parsing indices again.
+            Together with data, validators of all fetched indices are saved.
+        """
+        snapshot = { 'format': SNAPSHOT_FORMAT,
+                     'repos': self._repos,
+                     'arch': self._arch,
+                     'fields': self._fields,
+                     'package_filter': _package_filter_key(self._package_filter),
+                     'validators': self._validators,
+                     'indices': self._indices,
+                     'field_casing': DpkgParagraph.trueFieldCasing,
+                     'sources': self.sources,
+                     'binaries': self.binaries,
+                     'source_to_binaries_map': self.source_to_binaries_map,
+                     'pkgid_map': self.pkgid_map }
+        ofl = SafeWriteFile(path + ".new", path, "wb")
+        try:
+            cPickle.dump(snapshot, ofl, cPickle.HIGHEST_PROTOCOL)
+        except:
+            ofl.abort()
+            ofl.close()
+            raise
+        ofl.close()
+
+    def load_snapshot(self, path, validate = True, package_filter = None):
+        """
+            Loads metadata saved by save_snapshot(). Returns True on success.
+            Returns False if snapshot can't be used: it doesn't exist, was made
+            for other repositories/architectures/fields/package_filter or (if 
+            validate is True) some of the indices were changed since it was made.
+            In that case load_repos() should be used. Snapshots made with 
+            package_filter function are never used.
+        """
+        try:
+            ifl = open(path, "rb")
+        except IOError:
+            return False
+        # Unpickled objects aren't garbage, but their allocation triggers 
+        # collections, which scan all of them again and again
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            try:
+                snapshot = cPickle.load(ifl)
+            except Exception, exc:
+                self._logger.info("Unable to read snapshot %s: %s" % (path, exc))
+                return False
+        finally:
+            if enabled:
+                gc.enable()
+            ifl.close()
+
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            return False
+        if snapshot['repos'] != self._repos or snapshot['arch'] != self._arch:
+            return False
+        if snapshot.get('fields') != self._fields:
+            return False
+        filter_key = _package_filter_key(package_filter)
+        if filter_key is None or snapshot.get('package_filter', ()) != filter_key:
+            return False
+        if validate:
+            for (url, validators) in snapshot['validators'].items():
+                if not _url_unchanged(url, validators):
+                    self._logger.debug("Snapshot %s is outdated: %s changed" % (path, url))
+                    return False
+
+        DpkgParagraph.trueFieldCasing.update(snapshot['field_casing'])
+        self._validators = snapshot['validators']
+        self._indices = snapshot['indices']
+        self.sources = snapshot['sources']
+        self.binaries = snapshot['binaries']
+        self.source_to_binaries_map = snapshot['source_to_binaries_map']
+        self.pkgid_map = snapshot['pkgid_map']
+        self.rdepends_map = {}
+        self.provides_map = {}
+        self._package_filter = package_filter
+        self._best_versions = {}
+        self._key_indices = {}
+        self._generation += 1
+        return True
+
+    def iter_binaries(self, repo_filter = None, ignore_errors = True, package_filter = None):
+        """
+            Generator, which fetches binary indices and yields their packages one 
+            at a time without keeping them, so memory usage doesn't depend on
+            size of indices. Loaded data isn't changed. repo_filter selects
+            repositories the same way as base_url of get_* methods, package_filter
+            is the same as for load_repos().
+        """
+        return self.__iter_packages(True, repo_filter, ignore_errors, package_filter)
+
+    def iter_sources(self, repo_filter = None, ignore_errors = True, package_filter = None):
+        """The same as iter_binaries(), but for source packages"""
+        return self.__iter_packages(False, repo_filter, ignore_errors, package_filter)
+
+    def __iter_packages(self, binaries, repo_filter, ignore_errors, package_filter):
+        """Implementation of iter_binaries() and iter_sources()"""
+        releases = {}
+        # Validators of loaded data shouldn't be changed
+        validators = {}
+        package_filter = _make_package_filter(package_filter)
+        for repo in self._repos:
+            (base_url, url_srcs, url_bins) = self.__make_urls(repo)
+            if binaries:
+                repourls = url_bins
+            else:
+                repourls = url_srcs
+            for (url, distro, section) in repourls:
+                if repo_filter and not _filter_base_urls(repo_filter, {(base_url, distro, section): None}):
+                    continue
+                container = AptRepoMetadataBase(base_url, allowed_arches = self._arch, fields = self._fields,
+                                                compact = self._compact)
+                container.set_package_filter(package_filter)
+                release = self.__get_release(base_url, url, distro, section, releases, validators)
+                opened = self.__open_index(url, ignore_errors, release, validators)
+                if opened is None:
+                    continue
+                (fls, ext, checksum) = opened
+                # Index is closed even if generator isn't consumed till the end
+                try:
+                    try:
+                        for para in container.iter_load(fls):
+                            yield para
+                    except AptRepoException:
+                        raise
+                    except Exception, gene:
+                        raise AptRepoException("Unable to load: %s%s (%s)" % (url, ext, gene), gene)
+                finally:
+                    fls.close()
+
     def make_source_to_binaries_map(self):
         """Makes dictionary 'source_to_binaries' out of available packages"""
         if not self.binaries:
             # If no binary packages, try to load them
-            self.load_repos()
+            self.load_repos(package_filter = self._package_filter)
         if not self.source_to_binaries_map:
             # Map not present and needs to be generated
             for repo in self.binaries:
@@ -340,7 +1673,7 @@ class AptRepoClient(LoggableObject):
         """Makes dictionary 'pkgid_map' out of available source/binary packages"""
         if not self.binaries and not self.sources:
             # If no packages, try to load them
-            self.load_repos()
+            self.load_repos(package_filter = self._package_filter)
         if not self.pkgid_map:
             # Map not present and needs to be generated
             for repo in self.sources:
@@ -358,6 +1691,111 @@ class AptRepoClient(LoggableObject):
                             self.pkgid_map[pkgid] = []
                         self.pkgid_map[pkgid].append(pkg)
 
+    def make_rdepends_map(self, fields = ("depends", "pre-depends")):
+        """
+            Makes dictionary 'rdepends_map' out of relationship fields of 
+            available binary packages: package name -> list of 
+            (repository, package, field, relation) for every relation, which 
+            names the package, including alternatives. The map is reset when
+            repositories are reloaded.
+        """
+        if not self.binaries:
+            # If no binary packages, try to load them
+            self.load_repos(package_filter = self._package_filter)
+        fields = tuple(fields)
+        if self.rdepends_map is self._rdepends_made and self._rdepends_fields == fields:
+            return
+        self.rdepends_map = self._rdepends_made = {}
+        self._rdepends_fields = fields
+        for repo in self.binaries:
+            for pkgname in self.binaries[repo].keys():
+                for pkg in self.binaries[repo][pkgname]:
+                    for field in fields:
+                        for alternatives in self.__get_relations(pkg, field):
+                            for relation in alternatives:
+                                if relation.name not in self.rdepends_map:
+                                    self.rdepends_map[relation.name] = []
+                                self.rdepends_map[relation.name].append((repo, pkg, field, relation))
+
+    def make_provides_map(self):
+        """
+            Makes dictionary 'provides_map' out of Provides fields of available
+            binary packages: virtual package name -> list of
+            (repository, package, relation). The map is reset when repositories 
+            are reloaded.
+        """
+        if not self.binaries:
+            # If no binary packages, try to load them
+            self.load_repos(package_filter = self._package_filter)
+        if self.provides_map is not self._provides_made:
+            self.provides_map = self._provides_made = {}
+            for repo in self.binaries:
+                for pkgname in self.binaries[repo].keys():
+                    for pkg in self.binaries[repo][pkgname]:
+                        for alternatives in self.__get_relations(pkg, "provides"):
+                            for relation in alternatives:
+                                if relation.name not in self.provides_map:
+                                    self.provides_map[relation.name] = []
+                                self.provides_map[relation.name].append((repo, pkg, relation))
+
+    def get_rdepends(self, package, version = None, base_url = None, fields = None):
+        """
+            Return list of binary packages, which relationship fields (see 
+            make_rdepends_map) name package. If version is specified, only 
+            relations satisfied by this version of package are taken into 
+            account. base_url limits repositories of returned packages.
+            fields are the same as for make_rdepends_map(). By default fields
+            of already made map are used, Depends and Pre-Depends otherwise.
+        """
+        if fields is None:
+            fields = self._rdepends_fields or ("depends", "pre-depends")
+        self.make_rdepends_map(fields)
+        return self.__lookup_relations(self.rdepends_map.get(package, ()), version, base_url)
+
+    def get_providers(self, package, version = None, base_url = None):
+        """
+            Return list of binary packages, which provide virtual package. If
+            version is specified, only packages, which provide this version, 
+            are returned. base_url limits repositories of returned packages.
+        """
+        if version is not None and not isinstance(version, DpkgVersion):
+            try:
+                version = DpkgVersion.parse(version)
+            except VersionError:
+                self._logger.info("BadVersion: %s" % version)
+                return []
+        self.make_provides_map()
+        entries = self.provides_map.get(package, ())
+        if version is not None:
+            entries = [entry for entry in entries if entry[-1].constraint is not None and 
+                       entry[-1].constraint.relation == "=" and entry[-1].constraint.version == version]
+        return self.__lookup_relations(entries, None, base_url)
+
+    def __lookup_relations(self, entries, version, base_url):
+        """Return packages of rdepends_map/provides_map entries, which match version and base_url"""
+        if base_url:
+            repos = set(_filter_base_urls(base_url, self.binaries, self.__key_index(self.binaries)))
+        pkgs = []
+        seen = set()
+        for entry in entries:
+            (repo, pkg, relation) = (entry[0], entry[1], entry[-1])
+            if base_url and repo not in repos:
+                continue
+            if version is not None and not relation.matches_version(version):
+                continue
+            if id(pkg) not in seen:
+                seen.add(id(pkg))
+                pkgs.append(pkg)
+        return pkgs
+
+    def __get_relations(self, pkg, field):
+        """Return parsed relationship field of package. Broken fields are skipped"""
+        try:
+            return pkg.get_relations(field)
+        except DpkgRelationException, err:
+            self._logger.info("BadRelation: %s %s: %s" % (pkg['package'], field, err))
+            return ()
+
     def get_available_source_repos(self):
         """Lists known source repositories. Format is [ (base_url, distribution, section), ... ]"""
         return self.sources.keys()
@@ -395,54 +1833,66 @@ class AptRepoClient(LoggableObject):
             return self.__get_pkgs_by_name_version(package, version, base_url, self.sources)
 
     def get_available_binary_versions(self, package, base_url = None):
-        return _get_available_versions(package, base_url, self.binaries)
+        return _get_available_versions(package, base_url, self.binaries, self.__key_index(self.binaries))
 
     def get_available_source_versions(self, package, base_url = None):
-        return _get_available_versions(package, base_url, self.sources)
+        return _get_available_versions(package, base_url, self.sources, self.__key_index(self.sources))
 
     def get_available_sources(self, base_url = None):
-        return _get_available_pkgs(base_url, self.sources)
+        return _get_available_pkgs(base_url, self.sources, self.__key_index(self.sources))
 
     def get_available_binaries(self, base_url = None):
-        return _get_available_pkgs(base_url, self.binaries)
+        return _get_available_pkgs(base_url, self.binaries, self.__key_index(self.binaries))
+
+    def __key_index(self, pkgcache):
+        """Return _RepoKeyIndex for pkgcache. Indices are rebuilt after repositories reload"""
+        key_index = self._key_indices.get(id(pkgcache))
+        if key_index is None or len(key_index.keys) != len(pkgcache):
+            key_index = _RepoKeyIndex(pkgcache)
+            self._key_indices[id(pkgcache)] = key_index
+        return key_index
 
     def __get_best_version(self, package, base_url, pkgcache):
         """
             Should return touple (base_url,package_version) with the best version found in cache.
             If base_url is not specified, all repositories will be checked
         """
-        cache_keys = _filter_base_urls(base_url, pkgcache)
+        if not base_url:
+            try:
+                return self._best_versions[(id(pkgcache), package)]
+            except KeyError:
+                pass
+        cache_keys = _filter_base_urls(base_url, pkgcache, self.__key_index(pkgcache))
 
-        # Go trough all base_url keys
+        # Go trough all base_url keys. Best versions in every repository
+        # are precomputed, so only compare them
         best = None
         best_base_url = None
         for cache_key in cache_keys:
-            cache = pkgcache.get(cache_key, {})
-            if package in cache:
-                match = self.__pkg_best_match(cache[package])
-                if match:
-                    if not best:
-                        best = match
-                        # We're safe. this should not be assigned
-                        best_base_url = cache_key
-                    else:
-                        if DpkgVersion(match) > DpkgVersion(best):
-                            best = match
-                            best_base_url = cache_key
+            cache = pkgcache.get(cache_key)
+            if cache is None:
+                continue
+            match = cache.get_best_version(package)
+            if match is not None and (best is None or match > best):
+                best = match
+                best_base_url = cache_key
         if best is None:
-            return (None, None)
+            result = (None, None)
         else:
-            return (best_base_url, str(best))
+            result = (best_base_url, str(best))
+        if not base_url:
+            self._best_versions[(id(pkgcache), package)] = result
+        return result
 
     def __get_pkgs_by_name_version(self, package, version, base_url, pkgcache):
         """
            Should return array of packages, matched by name/vesion, from one or more base_urls
         """
-        cache_keys = _filter_base_urls(base_url, pkgcache)
+        cache_keys = _filter_base_urls(base_url, pkgcache, self.__key_index(pkgcache))
         
         if version is not None and not isinstance(version, DpkgVersion):
             try:
-                version = DpkgVersion(version)
+                version = DpkgVersion.parse(version)
             except VersionError:
                 # Bad input data. Return empty set
                 self._logger.info("BadVersion: %s" % version)
@@ -455,7 +1905,7 @@ class AptRepoClient(LoggableObject):
             if package in cache:
                 for pkg in cache[package]:
                     try:
-                        if version is not None and DpkgVersion(pkg['version']) == version:
+                        if version is not None and DpkgVersion.parse(pkg['version']) == version:
                             pkgs.append(pkg)
                     except VersionError:
                         # Package with bad version in repository. Let's skip it
@@ -463,27 +1913,6 @@ class AptRepoClient(LoggableObject):
                         continue
         return pkgs
 
-    def __pkg_best_match(self, cache):
-        """ Looks for best version available """
-        if len(cache) == 0:
-            # WTF!?
-            return None
-        try:
-            best = DpkgVersion(cache[0]['version'])
-        except VersionError:
-            self._logger.info("BadVersion: %s %s" % (cache[0]['package'], cache[0]['version']))
-            return None
-        if len(cache) > 1:
-            for pkg in cache:
-                try:
-                    pkg_ver = DpkgVersion(pkg['version'])
-                    if pkg_ver > best:
-                        best = pkg_ver
-                except VersionError:
-                    self._logger.info("BadVersion: %s %s" % (pkg['package'], pkg['version']))
-                    continue
-        return best 
-
     def __make_repos(self, repos = None, clear = True):
         """ Update available repositories array """
         def filter_repolines(repolines):
@@ -509,9 +1938,10 @@ class AptRepoClient(LoggableObject):
             self._repos += [repo for repo in filter_repolines(repos.splitlines()) if repo not in self._repos]
 
 
-    def __load_repos(self, repos, ignore_errors = True):
+    def __load_repos(self, repos, ignore_errors = True, clear = True, package_filter = None):
         """Should load data from remote repository. Format the same as sources.list"""
         to_load = []
+        releases = {}
         for repo in repos:
             (base_url, url_srcs, url_bins) = self.__make_urls(repo)
             if url_srcs:
@@ -526,46 +1956,368 @@ class AptRepoClient(LoggableObject):
 
             for (url, distro, section) in repourls:
                 if (base_url, distro, section) not in dest_dict:
-                    dest_dict[(base_url, distro, section)] = AptRepoMetadataBase(base_url, allowed_arches = self._arch)
+                    dest_dict[(base_url, distro, section)] = AptRepoMetadataBase(base_url, allowed_arches = self._arch,
+                            lazy = self._lazy, storage_dir = self._cache_dir, fields = self._fields,
+                            compact = self._compact, processes = self._processes)
                 dest = dest_dict[(base_url, distro, section)]
-                to_load.append((base_url, url, dest, ignore_errors))
+                dest.set_package_filter(package_filter)
+                release = self.__get_release(base_url, url, distro, section, releases)
+                to_load.append((base_url, url, dest, ignore_errors, release))
 
         stt = time.time()
-        for args in to_load:
-            self.__parse_one_repo(*args)
+        # Indices, which are not changed since previous load, are reused
+        results = [None] * len(to_load)
+        fetch = []
+        for idx in range(len(to_load)):
+            (base_url, url, dest, ignore_errors, release) = to_load[idx]
+            state = self._indices.get(url)
+            if state and release and release[0].get(release[1] + state[0]) == state[1]:
+                self._logger.debug("Index not changed: %s" % url)
+                results[idx] = ((state[2], state), None)
+            else:
+                fetch.append(idx)
+        if self._processes > 1 and multiprocessing and not self._lazy and fetch:
+            # Processes are forked before worker threads are started
+            self._pool = to_load[fetch[0]][2].make_pool()
+        try:
+            if self._workers > 1 and len(fetch) > 1:
+                self.__load_parallel(to_load, fetch, results)
+            else:
+                for idx in fetch:
+                    try:
+                        results[idx] = (self.__parse_one_repo(*to_load[idx]), None)
+                    except Exception, exc:
+                        results[idx] = (None, exc)
+                        break
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+        if clear:
+            self._indices = {}
+        # (base_url, package, version, checksum) -> Architecture: all paragraph
+        shared = {}
+        for idx in range(len(to_load)):
+            (loaded, exc) = results[idx]
+            if exc is not None:
+                raise exc
+            (part, state) = loaded
+            if part is None:
+                continue
+            url = to_load[idx][1]
+            if clear or self._indices.get(url) is not state:
+                _share_paragraphs(part, shared)
+                to_load[idx][2].merge(part)
+            if state:
+                self._indices[url] = state
         self._logger.debug("Parsing time: %f", time.time()-stt)
 
 
-    def __parse_one_repo(self, base_url, url, dest, ignore_errors):
-        """Loads one repository meta-data from URL and parses it to dest"""
-        # Let's check .gz variant first
-        try:
-            self._logger.debug("Fetching URL: %s.gz" % url)
-            fls = _universal_urlopen(url+".gz")
-        except urllib2.HTTPError, hte:
-            if hte.code == 404:
-                # If no Packages/Sources.gz found, let's try just Packages/Sources
+    def __load_parallel(self, to_load, fetch, results):
+        """
+            Fetches and parses indices from to_load, listed in fetch, in pool
+            of worker threads. Results and exceptions are stored to results.
+        """
+        # Jobs are queued per host, so workers don't wait for saturated
+        # hosts while jobs for other ones are pending
+        hosts = []
+        pending = {}
+        for idx in fetch:
+            host = urlparse.urlsplit(to_load[idx][1])[1]
+            if host not in pending:
+                hosts.append(host)
+                pending[host] = []
+            pending[host].append(idx)
+        active = dict.fromkeys(hosts, 0)
+        cond = threading.Condition()
+
+        def next_job():
+            """Return (host, job) for host with free connections or None if no jobs are left"""
+            cond.acquire()
+            try:
+                while 1:
+                    waiting = False
+                    for host in hosts:
+                        if not pending[host]:
+                            continue
+                        if self._per_host and active[host] >= self._per_host:
+                            waiting = True
+                            continue
+                        active[host] += 1
+                        return (host, pending[host].pop(0))
+                    if not waiting:
+                        return None
+                    cond.wait()
+            finally:
+                cond.release()
+
+        def worker():
+            """Takes jobs until all of them are taken"""
+            while 1:
+                job = next_job()
+                if job is None:
+                    return
+                (host, idx) = job
                 try:
-                    self._logger.debug("Compressed metadata not found. Fetching URL: %s" % url)
-                    fls = _universal_urlopen(url)
-                except urllib2.HTTPError, hte:
-                    if hte.code == 404:
-                        if ignore_errors:
-                            return
-                        else:
-                            raise AptRepoException("Unable to fetch: %s (HTTP Error code %d)" % (url, hte.code), hte)
-                    else:
-                        raise AptRepoException("Unable to fetch: %s (HTTP Error code %d)" % (url, hte.code), hte)
+                    try:
+                        results[idx] = (self.__parse_one_repo(*to_load[idx]), None)
+                    except Exception, exc:
+                        results[idx] = (None, exc)
+                finally:
+                    cond.acquire()
+                    try:
+                        active[host] -= 1
+                        cond.notifyAll()
+                    finally:
+                        cond.release()
+
+        threads = []
+        for idx in range(min(self._workers, len(fetch))):
+            thread = threading.Thread(target = worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+    def __get_release(self, base_url, url, distro, section, releases, validators = None):
+        """
+            Returns tuple (checksums, path of index in Release) for index url
+            or None if Release is not used or not available. Fetched Release 
+            files are stored to releases dictionary.
+        """
+        if not self._use_release:
+            return None
+        # Indices of flat repositories are next to Release file
+        if section:
+            release_dir = posixpath.join(base_url, "dists", distro)
+        else:
+            release_dir = posixpath.dirname(url)
+        if release_dir not in releases:
+            releases[release_dir] = self.__fetch_release(release_dir, validators)
+        if releases[release_dir] is None:
+            return None
+        return (releases[release_dir], url[len(release_dir)+1:])
+
+
+    def __fetch_release(self, release_dir, validators = None):
+        """
+            Fetches InRelease or Release file from release_dir and returns 
+            checksums of indices listed in it. Returns None if not available
+        """
+        if validators is None:
+            validators = self._validators
+        for name in ("InRelease", "Release"):
+            url = posixpath.join(release_dir, name)
+            try:
+                self._logger.debug("Fetching URL: %s" % url)
+                fls = _universal_urlopen(url, self._cache_dir)
+            except Exception, gene:
+                if _is_not_found(gene):
+                    validators[url] = None
+                    continue
+                self._logger.info("Unable to fetch: %s (%s)" % (url, gene))
+                return None
+            validators[url] = _response_validators(fls.headers)
+            try:
+                return _parse_release(fls)
+            finally:
+                fls.close()
+        return None
+
+
+    def __parse_one_repo(self, base_url, url, dest, ignore_errors, release = None):
+        """
+            Loads one repository meta-data from URL and parses it to a new 
+            container with the same settings as dest.
+            If release (checksums, path of index in it) is specified, the smallest
+            variant listed in Release is fetched and verified.
+            Returns tuple (container, state), where state is (extension, 
+            checksum) of loaded variant if it's known. (None, None) is 
+            returned if index was not found and ignore_errors is True
+        """
+        state = self._indices.get(url)
+        if release and state and self._use_pdiffs and self._cache_dir and \
+                release[1] + ".diff/Index" in release[0]:
+            try:
+                loaded = self.__update_with_pdiffs(url, release, state, dest)
+            except Exception, gene:
+                self._logger.info("Unable to apply pdiffs to %s: %s" % (url, gene))
+                loaded = None
+            if loaded:
+                return loaded
+            self._logger.debug("Falling back to full download of %s" % url)
+
+        opened = self.__open_index(url, ignore_errors, release)
+        if opened is None:
+            return (None, None)
+        (fls, ext, checksum) = opened
+
+        if release and self._use_pdiffs and self._cache_dir and \
+                release[1] + ".diff/Index" in release[0]:
+            # Keep uncompressed copy of index to apply pdiffs to it later
+            fls = _HTTPCache(self._cache_dir).keep_index(url, fls)
+
+        part = dest._empty_copy()
+        try:
+            try:
+                part.load(fls, base_url, self._pool)
+            except AptRepoException:
+                raise
+            except Exception, gene:
+                raise AptRepoException("Unable to load: %s%s (%s)" % (url, ext, gene), gene)
+        finally:
+            # Close socket after use
+            fls.close()
+        if checksum:
+            return (part, (ext, checksum, part))
+        return (part, None)
+
+
+    def __open_index(self, url, ignore_errors, release = None, validators = None):
+        """
+            Opens the best available compressed variant of index. If release 
+            (checksums, path of index in it) is specified, the smallest variant 
+            listed in Release is opened and verified while it's read.
+            Validators of fetched URLs are stored to validators (self._validators
+            by default). Returns tuple (file object, extension, checksum) or None
+            if index was not found and ignore_errors is True
+        """
+        if validators is None:
+            validators = self._validators
+        variants = self._compressions
+        if release:
+            (checksums, path) = release
+            listed = [(checksums[path + ext][2], pos, ext) for (pos, ext) in enumerate(self._compressions) if path + ext in checksums]
+            listed.sort()
+            if listed:
+                variants = [ext for (size, pos, ext) in listed]
+
+        # Try compressed variants in order of preference
+        fls = None
+        for ext in variants:
+            checksum = None
+            if release:
+                checksum = release[0].get(release[1] + ext)
+            try:
+                self._logger.debug("Fetching URL: %s%s" % (url, ext))
+                fls = _universal_urlopen(url + ext, self._cache_dir, checksum)
+                validators[url + ext] = _response_validators(fls.headers)
+                break
+            except Exception, gene:
+                if _is_not_found(gene):
+                    # Let's try next variant
+                    validators[url + ext] = None
+                    continue
+                if isinstance(gene, urllib2.HTTPError):
+                    raise AptRepoException("Unable to fetch: %s (HTTP Error code %d)" % (url + ext, gene.code), gene)
+                # Generic exception
+                raise AptRepoException("Unable to fetch: %s (%s)" % (url + ext, gene), gene)
+        if fls is None:
+            if ignore_errors:
+                return None
             else:
-                raise AptRepoException("Unable to fetch: %s (HTTP Error code %d)" % (url, hte.code), hte)
-        except Exception, gene:
-            # Generic exception
-            raise AptRepoException("Unable to fetch: %s (%s)" % (url, gene), gene)
-
-        dest.load(fls, base_url)
-        # Close socket after use
-        fls.close()
-        del fls
+                raise AptRepoException("Unable to fetch: %s (not found)" % url)
+        return (fls, ext, checksum)
+
+
+    def __update_with_pdiffs(self, url, release, state, dest):
+        """
+            Updates previously loaded index by applying patches from 
+            Packages.diff/ to its local copy. Only changed paragraphs are parsed. 
+            Returns tuple (container, state) or None if patches can't be applied
+            and full index should be downloaded. New container has the same 
+            settings as dest: previously loaded one could be restored from 
+            snapshot, which doesn't keep package filter.
+        """
+        (checksums, path) = release
+        cache = _HTTPCache(self._cache_dir)
+        index_path = cache.index_path(url)
+        if not os.path.isfile(index_path):
+            return None
+
+        self._logger.debug("Fetching URL: %s.diff/Index" % url)
+        fls = _universal_urlopen(url + ".diff/Index", self._cache_dir, checksums.get(path + ".diff/Index"))
+        try:
+            diff_index = _parse_diff_index(fls)
+        finally:
+            fls.close()
+        if not diff_index:
+            return None
+        (algo, current, history, patches) = diff_index
+
+        ifl = open(index_path, "rb")
+        try:
+            old_lines = ifl.readlines()
+        finally:
+            ifl.close()
+        local = hashlib.new(algo)
+        for line in old_lines:
+            local.update(line)
+        local = local.hexdigest()
+
+        # Patches, which should be applied to our copy, are listed in 
+        # history after its checksum
+        names = None
+        if local == current[0]:
+            names = []
+        else:
+            for idx in range(len(history)):
+                if history[idx][0] == local:
+                    names = [name for (digest, size, name) in history[idx:]]
+                    break
+        if names is None:
+            self._logger.debug("Local copy of %s is not in patches history" % url)
+            return None
+
+        lines = list(old_lines)
+        for name in names:
+            patch_url = posixpath.join(url + ".diff", name + ".gz")
+            self._logger.debug("Fetching URL: %s" % patch_url)
+            fls = _universal_urlopen(patch_url, self._cache_dir, patches.get(name))
+            try:
+                _apply_ed_patch(lines, fls)
+            finally:
+                fls.close()
+        result = hashlib.new(algo)
+        size = 0
+        for line in lines:
+            result.update(line)
+            size += len(line)
+        if (result.hexdigest(), size) != current:
+            self._logger.debug("Patched %s doesn't match Packages.diff/Index" % url)
+            return None
+
+        # Only paragraphs, which were added or removed by patches, are parsed
+        old_paras = _split_paragraphs(old_lines)
+        new_paras = _split_paragraphs(lines)
+        del old_lines
+        old_set = set(old_paras)
+        new_set = set(new_paras)
+        removed = [text for text in old_paras if text not in new_set]
+        added = [text for text in new_paras if text not in old_set]
+        del old_paras, new_paras, old_set, new_set
+        part = dest._empty_copy()
+        part.merge(state[2])
+        gone = part._empty_copy()
+        gone.load(cStringIO.StringIO("\n".join(removed)))
+        new = part._empty_copy()
+        new.load(cStringIO.StringIO("\n".join(added)))
+        part.replace_paragraphs(gone, new)
+        self._logger.debug("Applied %d patches to %s: %d paragraphs removed, %d added" % \
+                (len(names), url, len(removed), len(added)))
+
+        ofl = SafeWriteFile(index_path + ".new", index_path, "wb")
+        ofl.writelines(lines)
+        ofl.close()
+
+        ext = state[0]
+        if path + ext in checksums:
+            return (part, (ext, checksums[path + ext], part))
+        return (part, None)
 
 
     def __make_urls(self, repoline):
@@ -0,0 +1,470 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# AptRepoResolver.py
+#
+# This module implements dependency closure and installability checks
+# of binary packages loaded by AptRepoClient.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 2 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+# $Id$
+
+__revision__ = "r"+"$Revision$"[11:-2]
+__all__ = [ 'AptRepoResolver' ]
+
+from minideblib.AptRepoClient import _filter_base_urls
+from minideblib.DpkgRelation import DpkgRelation, DpkgRelationException
+from minideblib.DpkgVersion import DpkgVersion, VersionError
+from minideblib.LoggableObject import LoggableObject
+
+
+class AptRepoResolver(LoggableObject):
+    """
+        Computes dependency closures and checks installability of binary
+        packages of AptRepoClient. Only dependencies are taken into account:
+        Conflicts and Breaks are ignored, so a package is installable if every
+        relation of its dependency fields can be satisfied by an installable
+        package (itself or virtual one it provides) from target repositories.
+        Architectures are matched according to Multi-Arch: a package of other
+        architecture satisfies a relation only if it's Architecture: all,
+        Multi-Arch: foreign, or Multi-Arch: allowed and relation is ":any".
+        Architecture: all packages depend on packages of native architecture
+        (the first one of client, which isn't "all").
+
+        Resolved relations and results are memoized by package name, version,
+        architecture and checksum and shared by all queries. When repositories
+        are reloaded by client, results, which depend on added, removed or
+        changed packages, are dropped and the rest refer to new paragraphs.
+        If packages of client are modified in place, invalidate() should be
+        called with their names.
+    """
+    def __init__(self, client, base_url = None, fields = ("pre-depends", "depends")):
+        """
+            client - AptRepoClient with loaded binary packages
+            base_url - target repositories, the same as base_url of
+                       AptRepoClient.get_* methods. None means all repositories.
+            fields - dependency fields to follow
+        """
+        self.client = client
+        self.base_url = base_url
+        self.fields = tuple(fields)
+        self.native_arch = None
+        for arch in client._arch:
+            if arch != "all":
+                self.native_arch = arch
+                break
+        self.reset()
+
+    def reset(self):
+        """Forget all memoized results"""
+        self._repos = None
+        self._generation = None
+        # package key -> package of target repositories
+        self._index = None
+        # id(package) -> package key
+        self._keys = {}
+        # relation -> tuple of keys of packages, which satisfy it
+        self._candidates = {}
+        # package key -> tuple of (alternatives, candidate keys) for every relation
+        self._deps = {}
+        # package key -> keys of packages, which candidates include it
+        self._rdeps = {}
+        # package key -> installability
+        self._installable = {}
+
+    def invalidate(self, names):
+        """
+            Forget results, which depend on packages with names, e.g. packages
+            added, removed or changed in place since the previous check.
+        """
+        self.__sync(True)
+        self.__invalidate(set(names))
+
+    def candidates(self, relation):
+        """
+            Return tuple of packages from target repositories, which satisfy
+            relation (DpkgRelation). Real packages come first, from the best
+            version, then packages, which provide it.
+        """
+        self.__sync()
+        return tuple([self._index[key] for key in self.__candidates(relation)])
+
+    def is_installable(self, package):
+        """Return True if package (name or paragraph) is installable"""
+        self.__sync()
+        key = self.__get_package(package)
+        if key is None:
+            return False
+        self.__solve([key])
+        return self._installable[key]
+
+    def closure(self, packages):
+        """
+            Computes dependency closure of packages (names or paragraphs).
+            For every relation already chosen or the first installable
+            candidate is picked. Returns tuple (list of packages, list of
+            unsatisfiable relations as (package, alternatives)). Packages
+            without installable candidates are reported with package None.
+        """
+        self.__sync()
+        roots = []
+        unsatisfiable = []
+        for package in packages:
+            key = self.__get_package(package)
+            if key is None:
+                unsatisfiable.append((None, (_root_relation(package),)))
+            else:
+                roots.append(key)
+        self.__solve(roots)
+
+        result = []
+        chosen = set()
+        roots.reverse()
+        todo = roots
+        while todo:
+            key = todo.pop()
+            if key in chosen:
+                continue
+            chosen.add(key)
+            result.append(self._index[key])
+            deps = list(self._deps[key])
+            deps.reverse()
+            for (alternatives, candidates) in deps:
+                pick = None
+                for cand in candidates:
+                    if cand in chosen:
+                        pick = cand
+                        break
+                if pick is None:
+                    for cand in candidates:
+                        if self._installable[cand]:
+                            pick = cand
+                            break
+                if pick is None:
+                    unsatisfiable.append((self._index[key], alternatives))
+                else:
+                    todo.append(pick)
+        return (result, unsatisfiable)
+
+    def explain(self, package):
+        """
+            Return list of (package, alternatives) for relations, which make
+            package (name or paragraph) uninstallable: they have no candidates
+            at all or can't be parsed (alternatives None). Empty for
+            installable packages.
+        """
+        self.__sync()
+        key = self.__get_package(package)
+        if key is None:
+            return [(None, (_root_relation(package),))]
+        self.__solve([key])
+        problems = []
+        seen = set()
+        todo = [key]
+        while todo:
+            key = todo.pop()
+            if key in seen or self._installable[key]:
+                continue
+            seen.add(key)
+            for (alternatives, candidates) in self._deps[key]:
+                if not candidates:
+                    problems.append((self._index[key], alternatives))
+                elif not [cand for cand in candidates if self._installable[cand]]:
+                    todo.extend(candidates)
+        return problems
+
+    def check(self, packages = None):
+        """
+            Checks installability of packages (names or paragraphs), all
+            packages of target repositories by default. Returns list of
+            (package, explain(package)) for uninstallable ones.
+        """
+        self.__sync()
+        if packages is None:
+            packages = []
+            for repo in self.__target_repos():
+                for name in self.client.binaries[repo].keys():
+                    packages.extend(self.client.binaries[repo][name])
+        keys = []
+        result = []
+        for package in packages:
+            key = self.__get_package(package)
+            if key is None:
+                result.append((package, [(None, (_root_relation(package),))]))
+            else:
+                keys.append(key)
+        self.__solve(keys)
+        for key in _unique(keys):
+            if not self._installable[key]:
+                result.append((self._index[key], self.explain(self._index[key])))
+        return result
+
+    def __sync(self, force = False):
+        """
+            Binds results to packages currently loaded by client. If they were
+            reloaded since the previous query, results, which depend on added,
+            removed or changed packages, are dropped.
+        """
+        if self._index is not None and not force and self._generation == self.client._generation:
+            return
+        self._generation = self.client._generation
+        self._repos = None
+        index = {}
+        keys = {}
+        for repo in self.__target_repos():
+            for name in self.client.binaries[repo].keys():
+                for pkg in self.client.binaries[repo][name]:
+                    key = _package_key(pkg, repo)
+                    index.setdefault(key, pkg)
+                    keys[id(pkg)] = key
+        previous = self._index
+        self._index = index
+        self._keys = keys
+        if previous is not None:
+            names = set()
+            for key in previous:
+                if key not in index:
+                    names.add(key[0])
+            for key in index:
+                if key not in previous:
+                    names.add(key[0])
+            if names:
+                self.__invalidate(names)
+
+    def __invalidate(self, names):
+        """Forget results, which depend on packages with names"""
+        # Virtual packages provided by new versions could be satisfied by them now
+        provided = set()
+        for repo in self.__target_repos():
+            for name in names:
+                for pkg in self.client.binaries[repo].get(name, ()):
+                    for alternatives in self.__get_relations(pkg, "provides"):
+                        provided.update([relation.name for relation in alternatives])
+        names.update(provided)
+
+        for relation in self._candidates.keys():
+            if relation.name in names or \
+                    [key for key in self._candidates[relation] if key[0] in names]:
+                del self._candidates[relation]
+
+        todo = []
+        for (key, deps) in self._deps.items():
+            if key[0] in names:
+                todo.append(key)
+                continue
+            for (alternatives, candidates) in deps:
+                if alternatives and [relation for relation in alternatives if relation.name in names]:
+                    todo.append(key)
+                    break
+        # Packages, which depend on invalidated ones, are invalidated too
+        while todo:
+            key = todo.pop()
+            deps = self._deps.pop(key, None)
+            if deps is None:
+                continue
+            self._installable.pop(key, None)
+            for (alternatives, candidates) in deps:
+                for cand in candidates:
+                    if cand in self._rdeps:
+                        self._rdeps[cand].discard(key)
+            todo.extend(self._rdeps.pop(key, ()))
+
+    def __candidates(self, relation):
+        """Return memoized tuple of keys of packages, which satisfy relation"""
+        try:
+            return self._candidates[relation]
+        except KeyError:
+            pass
+        real = []
+        for repo in self.__target_repos():
+            for pkg in self.client.binaries[repo].get(relation.name, ()):
+                try:
+                    version = DpkgVersion.parse(pkg['version'])
+                except VersionError:
+                    continue
+                if relation.matches_version(version):
+                    real.append((version.getSortKey(), self._keys[id(pkg)]))
+        real.sort(lambda x, y: -cmp(x[0], y[0]))
+        result = [key for (version, key) in real]
+
+        self.client.make_provides_map()
+        repos = set(self.__target_repos())
+        for (repo, pkg, provided) in self.client.provides_map.get(relation.name, ()):
+            if repo not in repos:
+                continue
+            if relation.constraint is not None:
+                # Only versioned Provides satisfy versioned relations
+                if provided.constraint is None or provided.constraint.relation != "=" or \
+                        not relation.constraint.matches(provided.constraint.version):
+                    continue
+            result.append(self._keys[id(pkg)])
+
+        result = tuple(_unique(result))
+        self._candidates[relation] = result
+        return result
+
+    def __solve(self, roots):
+        """
+            Computes installability of roots and all packages they depend on.
+            Dependency cycles are allowed, so every package is assumed to be
+            installable, then packages with unsatisfiable relations are marked
+            uninstallable and this is propagated to packages, which depend on
+            them, until nothing changes. Each relation counts its installable
+            candidates, so every dependency is processed once.
+        """
+        nodes = set()
+        todo = [key for key in roots if key not in self._installable]
+        while todo:
+            key = todo.pop()
+            if key in nodes:
+                continue
+            nodes.add(key)
+            for (alternatives, candidates) in self.__deps(key):
+                for cand in candidates:
+                    if cand not in nodes and cand not in self._installable:
+                        todo.append(cand)
+
+        # (package key, relation position) -> number of installable candidates
+        counts = {}
+        # candidate key -> list of (package key, relation position)
+        parents = {}
+        broken = []
+        for key in nodes:
+            deps = self._deps[key]
+            for pos in range(len(deps)):
+                count = 0
+                for cand in deps[pos][1]:
+                    if cand in nodes:
+                        count += 1
+                        parents.setdefault(cand, []).append((key, pos))
+                    elif self._installable[cand]:
+                        count += 1
+                counts[(key, pos)] = count
+                if not count:
+                    broken.append(key)
+
+        status = dict.fromkeys(nodes, True)
+        while broken:
+            key = broken.pop()
+            if not status[key]:
+                continue
+            status[key] = False
+            for (parent, pos) in parents.get(key, ()):
+                counts[(parent, pos)] -= 1
+                if not counts[(parent, pos)] and status[parent]:
+                    broken.append(parent)
+        self._installable.update(status)
+
+    def __deps(self, key):
+        """Return memoized tuple of (alternatives, candidate keys) for relations of package"""
+        try:
+            return self._deps[key]
+        except KeyError:
+            pass
+        pkg = self._index[key]
+        arch = pkg.get('architecture')
+        if arch in (None, "all"):
+            arch = self.native_arch
+        deps = []
+        for field in self.fields:
+            try:
+                relations = pkg.get_relations(field)
+            except DpkgRelationException, err:
+                self._logger.info("BadRelation: %s %s: %s" % (pkg['package'], field, err))
+                # Broken field can't be satisfied
+                deps.append((None, ()))
+                continue
+            for alternatives in relations:
+                candidates = []
+                for relation in alternatives:
+                    candidates.extend([cand for cand in self.__candidates(relation)
+                                       if self.__arch_matches(arch, relation, cand)])
+                candidates = tuple(_unique(candidates))
+                for cand in candidates:
+                    self._rdeps.setdefault(cand, set()).add(key)
+                deps.append((alternatives, candidates))
+        self._deps[key] = deps = tuple(deps)
+        return deps
+
+    def __arch_matches(self, arch, relation, key):
+        """Checks if package with key can satisfy relation of package for arch"""
+        qualifier = relation.archqual
+        if qualifier == "native":
+            (arch, qualifier) = (self.native_arch, None)
+        elif qualifier not in (None, "any"):
+            return key[2] in (qualifier, "all")
+        if arch is None or key[2] in (None, "all", arch):
+            return True
+        multiarch = self._index[key].get('multi-arch')
+        return multiarch == "foreign" or (multiarch == "allowed" and qualifier == "any")
+
+    def __get_package(self, package):
+        """Return key of package name (the best installable version) or paragraph itself"""
+        if not isinstance(package, basestring):
+            try:
+                return self._keys[id(package)]
+            except KeyError:
+                pass
+            # Package from other repository
+            key = _package_key(package, None)
+            self._index.setdefault(key, package)
+            self._keys[id(package)] = key
+            return key
+        candidates = [key for key in self.__candidates(_root_relation(package)) if key[0] == package]
+        if not candidates:
+            return None
+        self.__solve(candidates)
+        for key in candidates:
+            if self._installable[key]:
+                return key
+        return candidates[0]
+
+    def __get_relations(self, pkg, field):
+        """Return parsed relationship field of package. Broken fields are skipped"""
+        try:
+            return pkg.get_relations(field)
+        except DpkgRelationException:
+            return ()
+
+    def __target_repos(self):
+        """Return keys of target repositories"""
+        if self._repos is None:
+            self._repos = _filter_base_urls(self.base_url, self.client.binaries)
+        return self._repos
+
+
+def _package_key(pkg, repo):
+    """
+        Return key of package, which stays the same when repositories are
+        reloaded. Packages loaded without checksums are told apart by repository.
+    """
+    checksum = pkg.get('sha256') or pkg.get('md5sum') or repo
+    return (pkg['package'], pkg['version'], pkg.get('architecture'), checksum)
+
+def _root_relation(name):
+    """Return unversioned relation to package name"""
+    return DpkgRelation(name)
+
+def _unique(keys):
+    """Return list of keys without duplicates, keeping their order"""
+    seen = set()
+    result = []
+    for key in keys:
+        if key not in seen:
+            seen.add(key)
+            result.append(key)
+    return result
@@ -170,7 +170,7 @@ class DpkgChangelog:
         entry = DpkgChangelogEntry()
         entry.package = match.group("package")
         try:
-            entry.version = DpkgVersion.DpkgVersion(match.group("version"))
+            entry.version = DpkgVersion.DpkgVersion.parse(match.group("version"))
         except Exception, e:
             raise DpkgChangelogException("Invalid version: %s" % e, self.lineno)
 
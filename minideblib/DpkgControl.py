@@ -33,49 +33,258 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
-import re, string
+import os, re, string, urllib
+from cStringIO import StringIO
 from minideblib.DpkgDatalist import *
+from minideblib.DpkgDatalist import _DpkgDatalist
 from minideblib.SignedFile import *
 from types import ListType
 
+# Finds fields of paragraph text: (name, value, continuation lines)
+_findFields = re.compile( r'^([^ \t\n][^:\n]*):(?:[^\n])?([^\n]*)((?:\n[ \t][^\n]*)*)', re.M ).findall
+
+def _intern( text ):
+    "Intern str. intern() doesn't accept unicode, so it's returned as is"
+    if type( text ) is str:
+        return intern( text )
+    return text
+
 class DpkgParagraph(DpkgOrderedDatalist):
     caseSensitive = 0
     trueFieldCasing = {}
+    fields = None
+    # Values of these fields are interned: they are repeated in many paragraphs
+    internValues = { 'section': 1, 'priority': 1, 'architecture': 1, 'maintainer': 1,
+                     'multi-arch': 1, 'origin': 1, 'bugs': 1, 'essential': 1,
+                     'build-essential': 1, 'important': 1, 'protected': 1 }
+    filterField = None
+    filterFunc = None
+    # Cache of parseText() and settings it was made for
+    _layouts = None
+    _layoutsConfig = None
 
     def setCaseSensitive( self, value ):    self.caseSensitive = value
 
-    def load( self, f ):
-        "Paragraph data from a file object."
+    def setInternValues( self, fields ):
+        """Set names of fields, which values should be interned. Names should
+        be in the same case as keys are stored."""
+        self.internValues = fields
+
+    def setFilter( self, field, func ):
+        """Skip paragraphs for which func(value of field) returns false.
+        Skipped paragraphs are not parsed, load() goes on with next one."""
+        self.filterField = field
+        self.filterFunc = func
+
+    def setFields( self, fields ):
+        """Load only listed fields. Names should be in the same case as keys
+        are stored (lowercase unless paragraph is case sensitive).
+        None means all fields."""
+        self.fields = fields
+
+    def parse( self, f ):
+        """Read paragraph from a file object. Returns lists of field names
+        and their values, which are empty at end of file. Paragraph itself
+        is not changed."""
+        keys = []
+        values = []
+        positions = {}
         key = None
         value = None
+        started = 0
+        skip = 0
         while 1:
             line = f.readline()
             if not line: 
-                return
+                break
             # skip blank lines until we reach a paragraph
             if line == '\n':
-                if not self:
+                if not started:
                     continue
                 else:
-                    return
+                    break
             if line[ 0 ] == '#':
                 # Skip commentaries
                 continue
+            started = 1
             line = line[ :-1 ]
             if line[ 0 ] not in [' ', '\t']:
                 key, value = string.split( line, ":", 1 )
                 if value: value = value[ 1: ]
                 if not self.caseSensitive:
-                    newkey = string.lower( key )
+                    newkey = _intern( string.lower( key ) )
                     if not self.trueFieldCasing.has_key( key ):
                         self.trueFieldCasing[ newkey ] = key
                     key = newkey
+                else:
+                    key = _intern( key )
+                if key in self.internValues:
+                    value = _intern( value )
+                if key == self.filterField and not self.filterFunc( value ):
+                    # Skip the rest of paragraph and start again
+                    while 1:
+                        line = f.readline()
+                        if not line:
+                            break
+                        if line == '\n':
+                            break
+                    keys = []
+                    values = []
+                    positions = {}
+                    key = None
+                    value = None
+                    started = 0
+                    skip = 0
+                    if not line:
+                        break
+                    continue
+                skip = self.fields is not None and key not in self.fields
+                if skip:
+                    continue
             else:
+                if skip:
+                    continue
                 if isinstance( value, ListType ):
                     value.append( line[ 1: ] )
                 else:
                     value = [ value, line[ 1: ] ]
-            self[ key ] = value
+            pos = positions.get( key )
+            if pos is None:
+                positions[ key ] = len( keys )
+                keys.append( key )
+                values.append( value )
+            else:
+                values[ pos ] = value
+        return ( keys, values )
+
+    def parseText( self, text ):
+        """Parse paragraph from text without blank lines and trailing newline.
+        Returns lists of field names and values like parse(). They are
+        empty if paragraph is rejected by filter."""
+        if text[ :1 ] in ( '#', ' ', '\t' ) or text.find( '\n#' ) >= 0:
+            # Rare cases: commentaries, continuation line without field
+            return self.parse( StringIO( text + '\n' ) )
+        found = _findFields( text )
+        ( rawkeys, values, conts ) = zip( *found ) or ( (), (), () )
+        if len( found ) + string.join( conts, '' ).count( '\n' ) != text.count( '\n' ) + 1:
+            # Some lines have no colon, let parse() fail on them
+            return self.parse( StringIO( text + '\n' ) )
+
+        # Paragraphs with the same fields are parsed the same way
+        config = ( self.caseSensitive, self.fields, self.filterField, self.internValues )
+        if self._layoutsConfig != config:
+            self._layouts = {}
+            self._layoutsConfig = config
+        form = ( rawkeys, tuple( map( bool, conts ) ) )
+        try:
+            layout = self._layouts[ form ]
+        except KeyError:
+            layout = self._layouts[ form ] = self._makeLayout( rawkeys, conts )
+        ( keys, sources, interned, continued, filtered, casing ) = layout
+
+        values = list( values )
+        for pos in interned:
+            values[ pos ] = _intern( values[ pos ] )
+        for pos in filtered:
+            if not self.filterFunc( values[ pos ] ):
+                if not self.caseSensitive:
+                    self._updateCasing( rawkeys[ :pos + 1 ] )
+                return ( [], [] )
+        if casing is None:
+            self._updateCasing( rawkeys )
+        else:
+            self.trueFieldCasing.update( casing )
+        for pos in continued:
+            values[ pos ] = [ values[ pos ] ] + [ line[ 1: ] for line in conts[ pos ][ 1: ].split( '\n' ) ]
+        if sources is not None:
+            values = [ values[ pos ] for pos in sources ]
+        return ( list( keys ), values )
+
+    def _updateCasing( self, rawkeys ):
+        "Remember original casing of field names the same way as parse()"
+        for key in rawkeys:
+            if not self.trueFieldCasing.has_key( key ):
+                self.trueFieldCasing[ string.lower( key ) ] = key
+
+    def _makeLayout( self, rawkeys, conts ):
+        """Precompute parsing of paragraphs with given field names and
+        continuation lines. Returns tuple of resulting field names, positions
+        of their values (None if all fields are kept in order), positions of
+        values to intern, positions of values with continuation lines,
+        positions of filtered field and casing of field names for
+        trueFieldCasing ({} if not needed, None if it should be updated by
+        _updateCasing())."""
+        if self.caseSensitive:
+            keys = map( _intern, rawkeys )
+            casing = {}
+        else:
+            keys = [ _intern( string.lower( key ) ) for key in rawkeys ]
+            casing = {}
+            for pos in range( len( keys ) ):
+                if rawkeys[ pos ] == keys[ pos ]:
+                    # Lowercase field name can be already in trueFieldCasing
+                    casing = None
+                    break
+                casing[ keys[ pos ] ] = rawkeys[ pos ]
+        positions = range( len( keys ) )
+        interned = [ pos for pos in positions if keys[ pos ] in self.internValues ]
+        continued = [ pos for pos in positions if conts[ pos ] ]
+        filtered = [ pos for pos in positions if keys[ pos ] == self.filterField ]
+        # Repeated field keeps position of the first one and value of the last
+        result = []
+        sources = []
+        for pos in positions:
+            if self.fields is not None and keys[ pos ] not in self.fields:
+                continue
+            if keys[ pos ] in result:
+                sources[ result.index( keys[ pos ] ) ] = pos
+            else:
+                result.append( keys[ pos ] )
+                sources.append( pos )
+        if sources == positions:
+            sources = None
+        return ( tuple( result ), sources, interned, continued, filtered, casing )
+
+    def iterParse( self, f, size = 65536 ):
+        """Generator, which yields ( keys, values ) for every paragraph of
+        file object, like repeated calls to parse(). File is read by chunks
+        of size and split on blank lines, so nothing else should read it.
+        Objects without read() method are parsed line by line."""
+        if not hasattr( f, 'read' ):
+            while 1:
+                ( keys, values ) = self.parse( f )
+                if not keys:
+                    return
+                yield ( keys, values )
+        buf = ''
+        while buf is not None:
+            data = f.read( size )
+            if data:
+                blocks = ( buf + data ).split( '\n\n' )
+                buf = blocks.pop()
+            else:
+                # Strip newline of the last line. If there is no newline, 
+                # last character is lost like in parse()
+                blocks = [ buf[ :-1 ] ]
+                buf = None
+            for block in blocks:
+                # Blank lines before paragraph
+                if block[ :1 ] == '\n':
+                    block = block.lstrip( '\n' )
+                if not block:
+                    continue
+                ( keys, values ) = self.parseText( block )
+                if keys:
+                    yield ( keys, values )
+
+    def load( self, f ):
+        "Paragraph data from a file object."
+        ( keys, values ) = self.parse( f )
+        if not self:
+            self.setlists( keys, values )
+            return
+        for pos in range( len( keys ) ):
+            self[ keys[ pos ] ] = values[ pos ]
 
     def _storeField( self, f, value, lead = " " ):
         if isinstance( value, ListType ):
@@ -93,24 +302,151 @@ class DpkgParagraph(DpkgOrderedDatalist):
             f.write( "%s:" % key )
             self._storeField( f, value )
 
+class _ParagraphSchema(object):
+    "Field names of DpkgCompactParagraph and their positions"
+    __slots__ = ( 'keys', 'index' )
+
+    def __init__( self, keys ):
+        self.keys = keys
+        self.index = {}
+        for pos in range( len( keys ) ):
+            self.index[ keys[ pos ] ] = pos
+
+# Schemas are shared by all paragraphs with the same fields
+_schemas = {}
+
+def _getSchema( keys ):
+    keys = tuple( keys )
+    try:
+        return _schemas[ keys ]
+    except KeyError:
+        return _schemas.setdefault( keys, _ParagraphSchema( keys ) )
+
+class DpkgCompactParagraph(object):
+    """Memory efficient read-mostly variant of DpkgParagraph. Field names
+    (in order) are kept in schema shared with other paragraphs, paragraph
+    itself holds only list of values. Supports the same mapping interface
+    and produces the same output as DpkgParagraph."""
+    __slots__ = ( '_schema', '_values' )
+    caseSensitive = 0
+    trueFieldCasing = DpkgParagraph.trueFieldCasing
+    filename = ""
+
+    def __init__( self, keys = (), values = () ):
+        self._schema = _getSchema( keys )
+        self._values = list( values )
+
+    def load( self, f ):
+        "Paragraph data from a file object."
+        parser = DpkgParagraph( None )
+        parser.setCaseSensitive( self.caseSensitive )
+        ( keys, values ) = parser.parse( f )
+        for pos in range( len( keys ) ):
+            self[ keys[ pos ] ] = values[ pos ]
+
+    def __getitem__( self, key ):
+        return self._values[ self._schema.index[ key ] ]
+
+    def __setitem__( self, key, value ):
+        pos = self._schema.index.get( key )
+        if pos is None:
+            self._schema = _getSchema( self._schema.keys + ( key, ) )
+            self._values.append( value )
+        else:
+            self._values[ pos ] = value
+
+    def __delitem__( self, key ):
+        pos = self._schema.index[ key ]
+        keys = self._schema.keys
+        self._schema = _getSchema( keys[ :pos ] + keys[ pos + 1: ] )
+        del self._values[ pos ]
+
+    def get( self, key, failobj = None ):
+        pos = self._schema.index.get( key )
+        if pos is None:
+            return failobj
+        return self._values[ pos ]
+
+    def setdefault( self, key, failobj = None ):
+        if not self.has_key( key ):
+            self[ key ] = failobj
+        return self[ key ]
+
+    def has_key( self, key ):       return self._schema.index.has_key( key )
+    def __contains__( self, key ):  return self.has_key( key )
+    def __len__( self ):            return len( self._schema.keys )
+    def __iter__( self ):           return iter( self.keys() )
+    def keys( self ):               return list( self._schema.keys )
+    def values( self ):             return list( self._values )
+    def items( self ):              return zip( self.keys(), self.values() )
+    def iterkeys( self ):           return iter( self.keys() )
+    def itervalues( self ):         return iter( self.values() )
+    def iteritems( self ):          return iter( self.items() )
+
+    def update( self, dict ):
+        for k, v in dict.items():
+            self[ k ] = v
+
+    def clear( self ):
+        self._schema = _getSchema( () )
+        self._values = []
+
+    def copy( self ):
+        return self.__class__( self._schema.keys, self._values )
+
+    def __cmp__( self, other ):
+        if isinstance( other, DpkgCompactParagraph ):
+            return cmp( self.items(), other.items() )
+        return cmp( dict( self.items() ), other )
+
+    def __repr__( self ):
+        return repr( dict( self.items() ) )
+
+    def __getstate__( self ):
+        return ( self._schema.keys, self._values )
+
+    def __setstate__( self, state ):
+        self._schema = _getSchema( state[ 0 ] )
+        self._values = state[ 1 ]
+
+    # Output is written the same way as by DpkgParagraph
+    _storeField = DpkgParagraph.__dict__[ '_storeField' ]
+    _store = DpkgParagraph.__dict__[ '_store' ]
+    store = _DpkgDatalist.__dict__[ 'store' ]
+
 class DpkgControl(DpkgOrderedDatalist):
 
     key = "package"
     caseSensitive = 0
+    fields = None
+    filter = None
 
     def setkey( self, key ):        self.key = key
     def setCaseSensitive( self, value ):    self.caseSensitive = value
+    def setFields( self, fields ):  self.fields = fields
+    def setFilter( self, func ):    self.filter = func
 
     def _load_one( self, f ):
         p = DpkgParagraph( None )
         p.setCaseSensitive( self.caseSensitive )
+        p.setFields( self.fields )
+        if self.filter is not None:
+            p.setFilter( self.key, self.filter )
         p.load( f )
+        if self.filter is not None:
+            del p.filterField, p.filterFunc
         return p
 
     def load( self, f ):
-        while 1:
-            p = self._load_one( f )
-            if not p: break
+        parser = DpkgParagraph( None )
+        parser.setCaseSensitive( self.caseSensitive )
+        parser.setFields( self.fields )
+        if self.filter is not None:
+            parser.setFilter( self.key, self.filter )
+        for ( keys, values ) in parser.iterParse( f ):
+            p = DpkgParagraph( None )
+            p.setCaseSensitive( self.caseSensitive )
+            p.setlists( keys, values )
             self[ p[ self.key ] ] = p
 
     def _store( self, f ):
@@ -120,6 +456,37 @@ class DpkgControl(DpkgOrderedDatalist):
             self[ key ]._store( f )
             f.write( "\n" )
 
+def iter_paragraphs( source, caseSensitive = 0, fields = None, filter = None, key = "package", compact = 0 ):
+    """Generator, which yields paragraphs of source one at a time without
+    keeping them, so memory usage doesn't depend on size of source. source
+    is a file object, file name or URL; compressed files are decompressed
+    by extension. fields, filter and key have the same meaning as for
+    DpkgControl. Paragraphs are DpkgCompactParagraph if compact is set."""
+    opened = None
+    if isinstance( source, basestring ):
+        from minideblib.AptRepoClient import _universal_urlopen
+        if source.find( "://" ) < 0:
+            source = "file://" + urllib.pathname2url( os.path.abspath( source ) )
+        source = opened = _universal_urlopen( source )
+    parser = DpkgParagraph( None )
+    parser.setCaseSensitive( caseSensitive )
+    parser.setFields( fields )
+    if filter is not None:
+        parser.setFilter( key, filter )
+    # Opened source is closed even if generator isn't consumed till the end
+    try:
+        for ( keys, values ) in parser.iterParse( source ):
+            if compact:
+                yield DpkgCompactParagraph( keys, values )
+            else:
+                p = DpkgParagraph( None )
+                p.setCaseSensitive( caseSensitive )
+                p.setlists( keys, values )
+                yield p
+    finally:
+        if opened is not None:
+            opened.close()
+
 class DpkgSourceControl( DpkgControl ):
     source = None
 
@@ -267,7 +267,7 @@ class DpkgDebPackage(LoggableObject):
             if match:
                 is_debian_changelog = 1
                 if since_version:
-                    if DpkgVersion(match.group('version')) <= since_version:
+                    if DpkgVersion.parse(match.group('version')) <= since_version:
                         break
             changes += line
 
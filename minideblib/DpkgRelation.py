@@ -0,0 +1,175 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+#
+# DpkgRelation.py
+#
+# This module implements parser for relationship fields of Debian
+# packages: Depends, Pre-Depends, Provides, Build-Depends, etc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 2 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+# $Id$
+
+import re
+from minideblib.DpkgVersion import VersionConstraint, VersionError
+
+__all__ = ['DpkgRelation', 'DpkgRelationException', 'parse_relations', 'RELATION_FIELDS']
+
+# Fields of binary and source packages with relationships
+RELATION_FIELDS = ('depends', 'pre-depends', 'recommends', 'suggests', 'enhances',
+                   'breaks', 'conflicts', 'replaces', 'provides',
+                   'build-depends', 'build-depends-indep', 'build-depends-arch',
+                   'build-conflicts', 'build-conflicts-indep', 'build-conflicts-arch')
+
+# Number of distinct fields and relations kept by parse_relations()
+RELATION_CACHE_SIZE = 65536
+
+# name[:archqual] [(op version)] [[arch ...]] [<profile ...> ...]
+RelationRegex = re.compile(r'^(?P<name>[a-zA-Z0-9][a-zA-Z0-9+.\-_]*)'
+                           r'(?::(?P<archqual>[a-zA-Z0-9][a-zA-Z0-9\-]*))?\s*'
+                           r'(?:\(\s*(?P<op><<|<=|>=|>>|=|<|>)\s*(?P<version>[^\s()]+)\s*\))?\s*'
+                           r'(?:\[(?P<arches>[^\]]*)\])?\s*'
+                           r'(?P<profiles>(?:<[^<>]*>\s*)*)$')
+ProfileRegex = re.compile(r'<([^<>]*)>')
+
+
+class DpkgRelationException(Exception):
+    """Exception generated on bad syntax of relationship field"""
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+
+class DpkgRelation(object):
+    """
+    One relation of relationship field, e.g. "libc6:any (>= 2.31) [amd64]".
+    Relations are shared between fields, so they must not be modified.
+
+    Properties:
+     - name: package name
+     - archqual: architecture qualifier ("any", "native", architecture) or None
+     - constraint: VersionConstraint or None
+     - arches: tuple of architectures in [...] (excluded ones start with "!")
+     - profiles: tuple of build profile lists in <...>, e.g. (("!nocheck",),)
+    """
+    __slots__ = ('name', 'archqual', 'constraint', 'arches', 'profiles')
+
+    def __init__(self, name, archqual=None, constraint=None, arches=(), profiles=()):
+        self.name = name
+        self.archqual = archqual
+        self.constraint = constraint
+        self.arches = arches
+        self.profiles = profiles
+
+    def matches_version(self, version):
+        """Return True if version (string or DpkgVersion) satisfies the relation"""
+        return self.constraint is None or self.constraint.matches(version)
+
+    def matches_arch(self, arch):
+        """Return True if relation applies to architecture arch"""
+        if not self.arches:
+            return True
+        if self.arches[0].startswith("!"):
+            return "!" + arch not in self.arches
+        return arch in self.arches
+
+    def __getstate__(self):
+        return (self.name, self.archqual, self.constraint, self.arches, self.profiles)
+
+    def __setstate__(self, state):
+        (self.name, self.archqual, self.constraint, self.arches, self.profiles) = state
+
+    def __eq__(self, other):
+        return isinstance(other, DpkgRelation) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __str__(self):
+        text = self.name
+        if self.archqual:
+            text += ":" + self.archqual
+        if self.constraint is not None:
+            text += " (%s)" % (self.constraint,)
+        if self.arches:
+            text += " [%s]" % " ".join(self.arches)
+        for profile in self.profiles:
+            text += " <%s>" % " ".join(profile)
+        return text
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self)
+
+
+# Parsed fields and relations, shared by all equal strings
+_fields = {}
+_relations = {}
+
+def _cache(cache, key, value):
+    """Store value to cache, which is emptied when it's full"""
+    if len(cache) >= RELATION_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+
+def _parse_relation(text):
+    """Parse one relation"""
+    try:
+        return _relations[text]
+    except KeyError:
+        pass
+    match = RelationRegex.match(text)
+    if not match:
+        raise DpkgRelationException("Bad relation: \"%s\"" % text)
+    constraint = None
+    if match.group("op"):
+        try:
+            constraint = VersionConstraint(match.group("op"), match.group("version"))
+        except VersionError, err:
+            raise DpkgRelationException("Bad version in relation \"%s\": %s" % (text, err))
+    arches = ()
+    if match.group("arches") is not None:
+        arches = tuple(match.group("arches").split())
+    profiles = tuple([tuple(profile.split()) for profile in ProfileRegex.findall(match.group("profiles"))])
+    relation = DpkgRelation(match.group("name"), match.group("archqual"), constraint, arches, profiles)
+    _cache(_relations, text, relation)
+    return relation
+
+def parse_relations(text):
+    """
+    Parse relationship field (string or list of lines of multiline field).
+    Returns tuple of alternatives, which are tuples of DpkgRelation objects:
+    "a | b (>= 1), c" gives ((a, b (>= 1)), (c,)). Results are cached and
+    shared by equal strings.
+    """
+    if isinstance(text, list):
+        text = " ".join(text)
+    try:
+        return _fields[text]
+    except KeyError:
+        pass
+    result = []
+    for group in text.split(","):
+        group = group.strip()
+        if not group:
+            # Trailing comma
+            continue
+        result.append(tuple([_parse_relation(relation.strip()) for relation in group.split("|")]))
+    result = tuple(result)
+    _cache(_fields, text, result)
+    return result
@@ -11,7 +11,7 @@ special methods to make dealing with them sweet.
 __author__    = "Scott James Remnant <scott@netsplit.com>"
 
 
-import re
+import re, threading, operator
 
 
 # Regular expressions make validating things easy
@@ -22,6 +22,33 @@ valid_revision = re.compile(r'^[A-Za-z0-9+.~]+$')
 # Character comparison table for upstream and revision components
 cmp_table = "~ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.:"
 
+# Sort weights of characters, end of string weights 0 (see deb_order)
+_weights = {}
+for _idx in range(len(cmp_table)):
+    _weights[cmp_table[_idx]] = _idx
+_weights["~"] = -1
+del _idx
+
+# Splits version component to alternating non-digit and digit parts
+_split_parts = re.compile(r'([^0-9]*)([0-9]*)').findall
+
+# Key of empty non-digit and digit parts
+_empty_part = (0, 0)
+
+# Non-digit part -> its weights. Most of versions share a few of them
+_part_weights = {}
+
+
+# Version relation in dependency fields, e.g. "(>= 2.31)"
+valid_constraint = re.compile(r'^\s*\(?\s*(<<|<=|>=|>>|=|<|>)\s*([0-9][^\s()]*)\s*\)?\s*$')
+
+# Relation -> test of sort keys. Obsolete "<" and ">" mean "<=" and ">="
+relation_ops = { "<<": operator.lt, "<=": operator.le, "=": operator.eq,
+                 ">=": operator.ge, ">>": operator.gt, "<": operator.le, ">": operator.ge }
+
+# Number of versions kept by DpkgVersion.parse()
+PARSE_CACHE_SIZE = 8192
+
 
 class VersionError(Exception): pass
 class BadInputError(VersionError): pass
@@ -39,17 +66,19 @@ class DpkgVersion(object):
 
     The comparison will be done according to Debian rules, so '1.2' will compare lower.
 
-    Properties:
+    Properties (read-only, since parsed versions are shared by parse()):
      - epoch: Epoch
      - upstream: Upstream version
      - revision: Debian/local revision
     """
+    # _key is sort key cached by getSortKey()
+    __slots__ = ('_epoch', '_upstream', '_revision', '_key')
 
     def __init__(self, ver):
         """Parse a string or number into the three components."""
-        self.epoch = None
-        self.upstream = None
-        self.revision = None
+        epoch = None
+        revision = None
+        self._key = None
 
         ver = str(ver)
         if not len(ver):
@@ -58,32 +87,67 @@ class DpkgVersion(object):
         # Epoch is component before first colon
         idx = ver.find(":")
         if idx != -1:
-            self.epoch = ver[:idx]
-            if not len(self.epoch):
+            epoch = ver[:idx]
+            if not len(epoch):
                 raise BadEpochError, "Epoch cannot be empty"
-            if not valid_epoch.search(self.epoch):
+            if not valid_epoch.search(epoch):
                 raise BadEpochError, "Bad epoch format"
             ver = ver[idx+1:]
 
         # Revision is component after last hyphen
         idx = ver.rfind("-")
         if idx != -1:
-            self.revision = ver[idx+1:]
-            if not len(self.revision):
+            revision = ver[idx+1:]
+            if not len(revision):
                 raise BadRevisionError, "Revision cannot be empty"
-            if not valid_revision.search(self.revision):
+            if not valid_revision.search(revision):
                 raise BadRevisionError, "Bad revision format"
             ver = ver[:idx]
 
         # Remaining component is upstream
-        self.upstream = ver
-        if not len(self.upstream):
+        if not len(ver):
             raise BadUpstreamError, "Upstream version cannot be empty"
-        if not valid_upstream.search(self.upstream):
+        if not valid_upstream.search(ver):
             raise BadUpstreamError, "Bad upstream version format"
 
-        if self.epoch is not None:
-            self.epoch = int(self.epoch)
+        if epoch is not None:
+            epoch = int(epoch)
+        self._epoch = epoch
+        self._upstream = ver
+        self._revision = revision
+
+    epoch = property(lambda self: self._epoch)
+    upstream = property(lambda self: self._upstream)
+    revision = property(lambda self: self._revision)
+
+    def __getstate__(self):
+        return (self._epoch, self._upstream, self._revision)
+
+    def __setstate__(self, state):
+        (self._epoch, self._upstream, self._revision) = state
+        self._key = None
+
+    def parse(cls, ver):
+        """Return parsed version like the constructor does, but shares objects
+        for the same strings. Recently used versions and errors are kept in
+        a bounded cache, so returned objects must not be modified."""
+        if isinstance(ver, cls):
+            return ver
+        return _parse_cache.lookup(cls, str(ver))
+
+    parse = classmethod(parse)
+
+    def cache_info(cls):
+        """Return tuple (hits, misses, maxsize, currsize) of parse() cache."""
+        return _parse_cache.info()
+
+    cache_info = classmethod(cache_info)
+
+    def cache_clear(cls):
+        """Clear parse() cache and its statistics."""
+        _parse_cache.clear()
+
+    cache_clear = classmethod(cache_clear)
 
     def getWithoutEpoch(self):
         """Return the version without the epoch."""
@@ -94,6 +158,18 @@ class DpkgVersion(object):
 
     without_epoch = property(getWithoutEpoch)
 
+    def getSortKey(self):
+        """Return tuple, which orders the same way as versions do.
+        It's computed on first use."""
+        if self._key is None:
+            epoch = self.epoch
+            if epoch is None:
+                epoch = 0
+            self._key = (epoch,) + deb_key(self.upstream) + deb_key(self.revision or "")
+        return self._key
+
+    sort_key = property(getSortKey)
+
     def __str__(self):
         """Return the class as a string for printing."""
         str = ""
@@ -112,27 +188,13 @@ class DpkgVersion(object):
 
     def __cmp__(self, other):
         """Compare two Version classes."""
-        other = DpkgVersion(other)
-
-        # Compare epochs only if they are not equal.
-        if self.epoch != other.epoch:
-            # Special cases for braindead packages
-            sepoch = self.epoch
-            oepoch = other.epoch
-            if sepoch is None:
-                sepoch = 0
-            if oepoch is None:
-                oepoch = 0
-            result = cmp(sepoch, oepoch)
-            if result != 0: return result
-
-        result = deb_cmp(self.upstream, other.upstream)
-        if result != 0: return result
-
-        result = deb_cmp(self.revision or "", other.revision or "")
-        if result != 0: return result
+        if not isinstance(other, DpkgVersion):
+            other = DpkgVersion.parse(other)
+        return cmp(self._key or self.getSortKey(), other._key or other.getSortKey())
 
-        return 0
+    def __hash__(self):
+        """Equal versions (e.g. "1.0" and "0:1.00") have equal hashes."""
+        return hash(self.getSortKey())
 
     def is_native(self):
         native = False
@@ -140,6 +202,262 @@ class DpkgVersion(object):
             native = True
         return native
 
+class VersionConstraint(object):
+    """
+    Version relation of dependency field, e.g. ">= 2.31" of "libc6 (>= 2.31)".
+
+    The relation is parsed once and checked against sort keys of versions:
+
+    >>> VersionConstraint(">= 2.31").filter(["2.30-1", "2.31-1"])
+    ['2.31-1']
+
+    Properties:
+     - relation: one of <<, <=, =, >=, >> (< and > are read as <= and >=)
+     - version: DpkgVersion
+    """
+
+    def __init__(self, relation, version=None):
+        """Parse relation string like "(>= 2.31)", or relation and version."""
+        if version is None:
+            match = valid_constraint.match(relation)
+            if not match:
+                raise BadInputError, "Bad version relation: %s" % (relation,)
+            (relation, version) = match.groups()
+        relation = relation.strip()
+        if relation == "<":
+            relation = "<="
+        elif relation == ">":
+            relation = ">="
+        if relation not in relation_ops:
+            raise BadInputError, "Bad version relation: %s" % (relation,)
+        self.relation = relation
+        self.version = DpkgVersion.parse(version)
+        self._key = self.version.getSortKey()
+        self._test = relation_ops[relation]
+
+    def matches(self, version):
+        """Return True if version (string or DpkgVersion) satisfies the
+        relation. Invalid versions don't satisfy it."""
+        if isinstance(version, DpkgVersion):
+            key = version._key or version.getSortKey()
+        else:
+            try:
+                key = DpkgVersion.parse(version).getSortKey()
+            except VersionError:
+                return False
+        return self._test(key, self._key)
+
+    __call__ = matches
+
+    def filter(self, candidates, invalid=None):
+        """Return list of candidates (strings or DpkgVersion objects), which
+        satisfy the relation. Invalid versions are appended to invalid list,
+        if it's given."""
+        candidates = list(candidates)
+        test = self._test
+        key = self._key
+        result = []
+        for (ver_key, pos) in _version_keys(candidates, invalid):
+            if test(ver_key, key):
+                result.append(candidates[pos])
+        return result
+
+    def __str__(self):
+        return "%s %s" % (self.relation, self.version)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self)
+
+    def __eq__(self, other):
+        return isinstance(other, VersionConstraint) and \
+               self.relation == other.relation and self._key == other._key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.relation, self._key))
+
+class _VersionCache:
+    """Bounded LRU cache of parsed versions. Entries are links of circular
+    list [previous, next, key, (version, error)], the oldest one follows root."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.links = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
+
+    def info(self):
+        return (self.hits, self.misses, self.maxsize, len(self.links))
+
+    def lookup(self, cls, ver):
+        key = (cls, ver)
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                # Move to the most recently used end
+                (prev, next) = link[:2]
+                prev[1] = next
+                next[0] = prev
+                last = self.root[0]
+                last[1] = self.root[0] = link
+                link[0] = last
+                link[1] = self.root
+                self.hits += 1
+                result = link[3]
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+        if link is None:
+            try:
+                result = (cls(ver), None)
+            except VersionError, err:
+                result = (None, err)
+            self.lock.acquire()
+            try:
+                if key not in self.links and self.maxsize > 0:
+                    if len(self.links) >= self.maxsize:
+                        oldest = self.root[1]
+                        self.root[1] = oldest[1]
+                        oldest[1][0] = self.root
+                        del self.links[oldest[2]]
+                    last = self.root[0]
+                    last[1] = self.root[0] = self.links[key] = [last, self.root, key, result]
+            finally:
+                self.lock.release()
+
+        if result[1] is not None:
+            raise result[1]
+        return result[0]
+
+_parse_cache = _VersionCache(PARSE_CACHE_SIZE)
+
+def version_key(ver):
+    """Return sort key of version string or DpkgVersion, e.g. for 
+    sorted(versions, key=version_key)."""
+    if not isinstance(ver, DpkgVersion):
+        ver = DpkgVersion.parse(ver)
+    return ver.getSortKey()
+
+def _version_keys(versions, invalid):
+    """Return list of (sort key, position) of valid versions. Invalid ones
+    are appended to invalid list, if it's given. Every distinct string is
+    parsed once; parse() cache isn't used to not evict its entries."""
+    keys = []
+    # string -> sort key or None if version is invalid
+    parsed = {}
+    pos = -1
+    for ver in versions:
+        pos += 1
+        if isinstance(ver, DpkgVersion):
+            keys.append((ver.getSortKey(), pos))
+            continue
+        try:
+            key = parsed[ver]
+        except KeyError:
+            try:
+                key = DpkgVersion(ver).getSortKey()
+            except VersionError:
+                key = None
+            parsed[ver] = key
+        if key is None:
+            if invalid is not None:
+                invalid.append(ver)
+        else:
+            keys.append((key, pos))
+    return keys
+
+def max_version(versions, invalid=None):
+    """Return the newest of versions (strings or DpkgVersion objects) as
+    it was given, or None if there are no valid versions. The first one
+    wins among equal versions. Invalid versions are skipped and appended
+    to invalid list, if it's given."""
+    versions = list(versions)
+    keys = _version_keys(versions, invalid)
+    if not keys:
+        return None
+    best = keys[0]
+    for item in keys:
+        if item[0] > best[0]:
+            best = item
+    return versions[best[1]]
+
+def sort_versions(versions, unique=False, reverse=False, invalid=None):
+    """Return list of versions (as they were given) sorted from the oldest
+    one, or from the newest if reverse is set. Equal versions keep their
+    order; if unique is set, only the first of them is kept. Invalid
+    versions are skipped and appended to invalid list, if it's given."""
+    versions = list(versions)
+    keys = _version_keys(versions, invalid)
+    keys.sort()
+    result = []
+    last = None
+    for (key, pos) in keys:
+        if unique and key == last:
+            continue
+        result.append(versions[pos])
+        last = key
+    if reverse:
+        result.reverse()
+    return result
+
+def rank_versions(versions, invalid=None):
+    """Return list of dense ranks of versions in their order: 0 for the
+    oldest version, equal versions have equal ranks. Ranks of invalid
+    versions are None; versions are appended to invalid list, if it's
+    given."""
+    versions = list(versions)
+    ranks = [None] * len(versions)
+    keys = _version_keys(versions, invalid)
+    keys.sort()
+    rank = -1
+    last = None
+    for (key, pos) in keys:
+        if key != last:
+            rank += 1
+            last = key
+        ranks[pos] = rank
+    return ranks
+
+def deb_key(x):
+    """Return tuple of integers, which orders version components the same 
+    way as deb_cmp.
+
+    Every non-digit part is represented by weights of its characters 
+    terminated by 0 (end of string) and every digit part by its value. 
+    deb_cmp compares missing parts of the shorter string as empty ones, 
+    so empty parts (0, 0) are appended as a sentinel. Only the first 
+    non-digit part may be empty, so the first pair is kept for empty 
+    strings as well. Keys of components can be concatenated."""
+    key = []
+    for (chars, digits) in _split_parts(x)[:-1]:
+        try:
+            key.extend(_part_weights[chars])
+        except KeyError:
+            weights = [_weights[char] for char in chars]
+            weights.append(0)
+            if len(_part_weights) < 4096:
+                _part_weights[chars] = weights
+            key.extend(weights)
+        key.append(int(digits or "0"))
+    if not key:
+        key.extend(_empty_part)
+    key.extend(_empty_part)
+    return tuple(key)
+
 def strcut(str, idx, accept):
     """Cut characters from str that are entirely in accept."""
     ret = ""
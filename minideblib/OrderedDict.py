@@ -73,4 +73,9 @@ class OrderedDict(UserDict):
         for k, v in dict.items():
             self.__setitem__(k, v)
 
+    def setlists(self, keys, values):
+        """Replace content by keys (which should be unique) and their values"""
+        self.__order=list(keys)
+        self.data=dict(zip(keys, values))
+
 # vim:ts=4:sw=4:et:
@@ -2,4 +2,4 @@
 # -*- coding: UTF-8 -*-
 # vim: sw=4 ts=4 expandtab ai
 
-__all__ = [ 'ChangeFile', 'DpkgVersion', 'DpkgControl', 'AptRepoClient', 'DpkgDebPackage', 'DpkgChangelog', 'LoggableObject' ]
+__all__ = [ 'ChangeFile', 'DpkgVersion', 'DpkgControl', 'AptRepoClient', 'AptRepoResolver', 'DpkgDebPackage', 'DpkgChangelog', 'DpkgRelation', 'LoggableObject' ]
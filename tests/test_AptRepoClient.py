@@ -0,0 +1,371 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import BaseHTTPServer, bz2, cStringIO, hashlib, multiprocessing, os, shutil, tempfile, threading, unittest, urllib, zlib
+
+from minideblib import AptRepoClient as client_module
+from minideblib.AptRepoClient import AptRepoClient, CompactAptRepoParagraph, LazyAptRepoParagraph
+
+PACKAGES = """Package: a
+Version: 1.0
+Architecture: amd64
+Depends: b
+
+Package: b
+Version: 1.0
+Architecture: amd64
+Provides: v (= 1.0)
+
+Package: ab
+Version: 1.0
+Architecture: amd64
+"""
+
+# Index before and after PATCH, which changes b, removes c and adds e
+OLD = """Package: a
+Version: 1.0
+Architecture: amd64
+
+Package: b
+Version: 1.0
+Architecture: amd64
+
+Package: c
+Version: 1.0
+Architecture: amd64
+
+Package: d
+Version: 1.0
+Architecture: amd64
+"""
+
+NEW = """Package: a
+Version: 1.0
+Architecture: amd64
+
+Package: b
+Version: 2.0
+Architecture: amd64
+
+Package: d
+Version: 1.0
+Architecture: amd64
+
+Package: e
+Version: 1.0
+Architecture: amd64
+"""
+
+PATCH = """15a
+
+Package: e
+Version: 1.0
+Architecture: amd64
+.
+9,12d
+6c
+Version: 2.0
+.
+"""
+
+
+def _gzip(text):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves PACKAGES for every index. Requests of server.blocked wait for server.event"""
+    def do_GET(self):
+        if self.server.blocked and self.server.blocked in self.path:
+            self.server.waited = self.server.event.wait(5)
+        self.server.event.set()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PACKAGES)))
+        self.end_headers()
+        self.wfile.write(PACKAGES)
+
+    def log_message(self, *args):
+        pass
+
+
+class AptRepoClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for section in ("main", "contrib"):
+            path = os.path.join(self.tmpdir, "dists", "stable", section, "binary-amd64")
+            os.makedirs(path)
+            fobj = open(os.path.join(path, "Packages"), "w")
+            fobj.write(PACKAGES)
+            fobj.close()
+        self.repo = "deb file://%s stable main" % urllib.pathname2url(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_client(self, repo = None, **kwargs):
+        client = AptRepoClient([repo or self.repo], arch = ["amd64"], use_release = False, **kwargs)
+        client.load_repos()
+        return client
+
+    def test_copy(self):
+        pkg = self.make_client().get_binary_name_version("a")[0]
+        self.assertTrue(isinstance(pkg, CompactAptRepoParagraph))
+        copy = pkg.copy()
+        self.assertTrue(isinstance(copy, CompactAptRepoParagraph))
+        self.assertEqual(copy.base_url, pkg.base_url)
+        self.assertEqual(copy.items(), pkg.items())
+
+    def test_copy_lazy(self):
+        pkg = self.make_client(lazy = True).get_binary_name_version("a")[0]
+        self.assertTrue(isinstance(pkg, LazyAptRepoParagraph))
+        copy = pkg.copy()
+        self.assertEqual(copy.__class__, CompactAptRepoParagraph)
+        self.assertEqual(copy.base_url, pkg.base_url)
+        self.assertEqual(copy["depends"], "b")
+
+    def test_package_filter(self):
+        def names(package_filter):
+            client = AptRepoClient([self.repo], arch = ["amd64"], use_release = False)
+            client.load_repos(package_filter = package_filter)
+            return sorted(client.binaries.values()[0].keys())
+        self.assertEqual(names("ab"), ["ab"])
+        self.assertEqual(names(set(["a", "b"])), ["a", "b"])
+        self.assertEqual(names(["a"]), ["a", "ab"])
+
+    def test_get_providers(self):
+        client = self.make_client()
+        self.assertEqual([pkg['package'] for pkg in client.get_providers("v")], ["b"])
+        self.assertEqual([pkg['package'] for pkg in client.get_providers("v", "1.0")], ["b"])
+        self.assertEqual(client.get_providers("v", "2.0"), [])
+        self.assertEqual(client.get_providers("v", "bad version"), [])
+
+    def test_empty_maps(self):
+        # Maps without entries are made once too
+        client = AptRepoClient([self.repo], arch = ["amd64"], use_release = False)
+        client.load_repos(package_filter = "a")
+        fields = []
+        get_relations = client._AptRepoClient__get_relations
+        def spy(pkg, field):
+            fields.append(field)
+            return get_relations(pkg, field)
+        client._AptRepoClient__get_relations = spy
+        for i in range(3):
+            self.assertEqual(client.get_providers("v"), [])
+            self.assertEqual(client.get_rdepends("a"), [])
+        self.assertEqual(sorted(fields), ["depends", "pre-depends", "provides"])
+        client.load_repos(package_filter = "a")
+        client.get_providers("v")
+        self.assertEqual(len(fields), 4)
+        # Replaced map is made again
+        client.provides_map = {}
+        client.get_providers("v")
+        self.assertEqual(len(fields), 5)
+
+    def test_concatenated_streams(self):
+        for (ext, compress) in ((".bz2", bz2.compress), (".gz", _gzip)):
+            first = compress(PACKAGES)
+            data = first + compress(PACKAGES)
+            # The first stream ends at the end of chunk or in the middle of it
+            for size in (len(first), len(first) - 1, len(first) + 1):
+                saved = client_module._CHUNK_SIZE
+                client_module._CHUNK_SIZE = size
+                try:
+                    response = client_module._Response(cStringIO.StringIO(data), {},
+                                                       client_module._DECOMPRESSORS[ext])
+                    self.assertEqual(response.read(), PACKAGES * 2)
+                finally:
+                    client_module._CHUNK_SIZE = saved
+
+    def test_get_rdepends(self):
+        client = self.make_client()
+        self.assertEqual([pkg['package'] for pkg in client.get_rdepends("b")], ["a"])
+        self.assertEqual(client.get_rdepends("b", fields = ("recommends",)), [])
+        # Map made by caller is kept
+        client.make_rdepends_map(("depends", "recommends"))
+        rdepends_map = client.rdepends_map
+        self.assertEqual([pkg['package'] for pkg in client.get_rdepends("b")], ["a"])
+        self.assertTrue(client.rdepends_map is rdepends_map)
+
+    def test_iter_binaries_close(self):
+        opened = []
+        urlopen = client_module._universal_urlopen
+        def spy(*args):
+            opened.append(urlopen(*args))
+            return opened[-1]
+        client_module._universal_urlopen = spy
+        try:
+            packages = AptRepoClient([self.repo], arch = ["amd64"], use_release = False).iter_binaries()
+            self.assertEqual(packages.next()["package"], "a")
+            packages.close()
+        finally:
+            client_module._universal_urlopen = urlopen
+        self.assertEqual([fobj.fileobj.fp for fobj in opened if fobj.fileobj.fp is not None], [])
+
+    def test_sharded(self):
+        # Every package is parsed by its own process, indices are loaded by threads
+        repo = self.repo + " contrib"
+        saved = (client_module._MIN_SHARD_SIZE, multiprocessing.cpu_count)
+        client_module._MIN_SHARD_SIZE = 1
+        multiprocessing.cpu_count = lambda: 3
+        try:
+            sharded = self.make_client(repo, processes = 3, workers = 2)
+        finally:
+            (client_module._MIN_SHARD_SIZE, multiprocessing.cpu_count) = saved
+        expected = self.make_client(repo)
+        self.assertEqual(sorted(sharded.binaries.keys()), sorted(expected.binaries.keys()))
+        for key in expected.binaries:
+            self.assertEqual(sharded.binaries[key].keys(), expected.binaries[key].keys())
+            for name in expected.binaries[key].keys():
+                self.assertEqual([pkg.items() for pkg in sharded.binaries[key][name]],
+                                 [pkg.items() for pkg in expected.binaries[key][name]])
+
+    def test_per_host(self):
+        # Job of the first host waits for the second one, which can be
+        # fetched only if a worker doesn't wait for the busy first host
+        event = threading.Event()
+        servers = []
+        for blocked in ("/one/", None):
+            server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+            (server.blocked, server.event, server.waited) = (blocked, event, None)
+            thread = threading.Thread(target = server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+            servers.append(server)
+        try:
+            urls = ["http://127.0.0.1:%d/" % server.server_address[1] for server in servers]
+            repos = ["deb %s one main" % urls[0], "deb %s two main" % urls[0], "deb %s three main" % urls[1]]
+            client = AptRepoClient(repos, arch = ["amd64"], use_release = False, compressions = [""],
+                                   workers = 2, per_host = 1)
+            client.load_repos()
+            self.assertTrue(servers[0].waited)
+            self.assertEqual(len(client.binaries), 3)
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+
+class PdiffTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.index_dir = os.path.join(self.tmpdir, "dists", "stable", "main", "binary-amd64")
+        os.makedirs(os.path.join(self.index_dir, "Packages.diff"))
+        self.repo = "deb file://%s stable main" % urllib.pathname2url(self.tmpdir)
+        self.publish(OLD)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, data):
+        fobj = open(os.path.join(self.tmpdir, path), "wb")
+        fobj.write(data)
+        fobj.close()
+
+    def publish(self, text, patches = (), current = None):
+        """Writes index, its Packages.diff/ with patches [(name, previous text, patch)] and Release"""
+        index = "SHA256-Current: %s %d\nSHA256-History:\n" % (current or hashlib.sha256(text).hexdigest(), len(text))
+        for (name, previous, patch) in patches:
+            index += " %s %d %s\n" % (hashlib.sha256(previous).hexdigest(), len(previous), name)
+        index += "SHA256-Download:\n"
+        for (name, previous, patch) in patches:
+            data = _gzip(patch)
+            self.write(os.path.join(self.index_dir, "Packages.diff", name + ".gz"), data)
+            index += " %s %d %s.gz\n" % (hashlib.sha256(data).hexdigest(), len(data), name)
+        release = "SHA256:\n"
+        for (name, data) in (("Packages", text), ("Packages.diff/Index", index)):
+            self.write(os.path.join(self.index_dir, name), data)
+            release += " %s %d main/binary-amd64/%s\n" % (hashlib.sha256(data).hexdigest(), len(data), name)
+        self.write(os.path.join("dists", "stable", "Release"), release)
+
+    def make_client(self):
+        return AptRepoClient([self.repo], arch = ["amd64"], cache_dir = self.cache_dir, compressions = [""])
+
+    def load(self, client, **kwargs):
+        """Loads repositories and returns list of fetched URLs"""
+        fetched = []
+        urlopen = client_module._universal_urlopen
+        def spy(url, *args):
+            fetched.append(url)
+            return urlopen(url, *args)
+        client_module._universal_urlopen = spy
+        try:
+            client.load_repos(**kwargs)
+        finally:
+            client_module._universal_urlopen = urlopen
+        return fetched
+
+    def assertLoaded(self, client, text):
+        """Checks that client has the same packages in the same order as loaded from text"""
+        self.write("Packages", text)
+        expected = AptRepoClient(["deb file://%s /" % urllib.pathname2url(self.tmpdir)], arch = ["amd64"],
+                                 use_release = False, compressions = [""])
+        expected.load_repos()
+        (loaded, expected) = (client.binaries.values()[0], expected.binaries.values()[0])
+        self.assertEqual(loaded.keys(), expected.keys())
+        for name in expected.keys():
+            self.assertEqual([pkg.items() for pkg in loaded[name]], [pkg.items() for pkg in expected[name]])
+
+    def test_apply_ed_patch(self):
+        lines = cStringIO.StringIO(OLD).readlines()
+        client_module._apply_ed_patch(lines, cStringIO.StringIO(PATCH))
+        self.assertEqual("".join(lines), NEW)
+        lines = ["a\n", "b\n"]
+        client_module._apply_ed_patch(lines, cStringIO.StringIO("0a\nc\n.\n"))
+        self.assertEqual(lines, ["c\n", "a\n", "b\n"])
+        self.assertRaises(client_module.AptRepoException, client_module._apply_ed_patch,
+                          lines, cStringIO.StringIO("1,2s/a/b/\n"))
+        self.assertRaises(client_module.AptRepoException, client_module._apply_ed_patch,
+                          lines, cStringIO.StringIO("1a\nc\n"))
+
+    def test_update(self):
+        client = self.make_client()
+        client.load_repos()
+        self.publish(NEW, [("patch", OLD, PATCH)])
+        fetched = self.load(client)
+        self.assertFalse([url for url in fetched if url.endswith("/Packages")])
+        self.assertTrue([url for url in fetched if url.endswith("/Packages.diff/patch.gz")])
+        # Changed package keeps its place
+        self.assertEqual(client.binaries.values()[0].keys(), ["a", "b", "d", "e"])
+        self.assertLoaded(client, NEW)
+
+    def test_broken_history(self):
+        # Local copy isn't in history, so full index is downloaded
+        client = self.make_client()
+        client.load_repos()
+        self.publish(NEW, [("patch", OLD + "\n", PATCH)])
+        fetched = self.load(client)
+        self.assertTrue([url for url in fetched if url.endswith("/Packages")])
+        self.assertFalse([url for url in fetched if url.endswith("/Packages.diff/patch.gz")])
+        self.assertLoaded(client, NEW)
+
+    def test_checksum_mismatch(self):
+        # Patched copy doesn't match Packages.diff/Index, so full index is downloaded
+        client = self.make_client()
+        client.load_repos()
+        self.publish(NEW, [("patch", OLD, PATCH)], hashlib.sha256(NEW + "\n").hexdigest())
+        fetched = self.load(client)
+        self.assertTrue([url for url in fetched if url.endswith("/Packages.diff/patch.gz")])
+        self.assertTrue([url for url in fetched if url.endswith("/Packages")])
+        self.assertLoaded(client, NEW)
+
+    def test_package_filter(self):
+        # Containers restored from snapshot don't keep filter
+        package_filter = set(["a", "b"])
+        client = self.make_client()
+        client.load_repos(package_filter = package_filter)
+        client.save_snapshot(os.path.join(self.tmpdir, "snapshot"))
+        client = self.make_client()
+        self.assertTrue(client.load_snapshot(os.path.join(self.tmpdir, "snapshot"), validate = False,
+                                             package_filter = package_filter))
+        self.publish(NEW, [("patch", OLD, PATCH)])
+        fetched = self.load(client, package_filter = package_filter)
+        self.assertFalse([url for url in fetched if url.endswith("/Packages")])
+        self.assertEqual(client.binaries.values()[0].keys(), ["a", "b"])
+        self.assertEqual(client.get_binary_name_version("b")[0]["version"], "2.0")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import os, shutil, tempfile, unittest, urllib
+
+from minideblib.AptRepoClient import AptRepoClient
+from minideblib.AptRepoResolver import AptRepoResolver
+
+PACKAGES = """Package: a
+Version: 1.0
+Architecture: amd64
+Depends: d
+
+Package: d
+Version: 1.0
+Architecture: amd64
+Provides: v
+
+Package: e
+Version: 1.0
+Architecture: amd64
+Depends: v, a
+"""
+
+MULTIARCH = {
+    "amd64": """Package: x
+Version: 1.0
+Architecture: amd64
+Depends: lib
+
+Package: y
+Version: 1.0
+Architecture: amd64
+Depends: tool, perl:any, v
+
+Package: z
+Version: 1.0
+Architecture: all
+Depends: lib
+""",
+    "i386": """Package: lib
+Version: 1.0
+Architecture: i386
+
+Package: tool
+Version: 1.0
+Architecture: i386
+Multi-Arch: foreign
+
+Package: perl
+Version: 1.0
+Architecture: i386
+Multi-Arch: allowed
+
+Package: data
+Version: 1.0
+Architecture: all
+Provides: v
+""" }
+
+
+class AptRepoResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.write_packages(PACKAGES)
+        self.client = AptRepoClient(["deb file://%s stable main" % urllib.pathname2url(self.tmpdir)],
+                                    arch = ["amd64"], use_release = False)
+        self.client.load_repos()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_packages(self, text, arch = "amd64"):
+        path = os.path.join(self.tmpdir, "dists", "stable", "main", "binary-" + arch)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        fobj = open(os.path.join(path, "Packages"), "w")
+        fobj.write(text)
+        fobj.close()
+
+    def test_installable(self):
+        resolver = AptRepoResolver(self.client)
+        self.assertEqual(resolver.check(), [])
+        (pkgs, unsatisfiable) = resolver.closure(["e"])
+        self.assertEqual(sorted([pkg['package'] for pkg in pkgs]), ["a", "d", "e"])
+        self.assertEqual(unsatisfiable, [])
+
+    def test_invalidate_provides(self):
+        resolver = AptRepoResolver(self.client)
+        self.assertTrue(resolver.is_installable("e"))
+        # d doesn't provide v anymore
+        self.write_packages(PACKAGES.replace("Provides: v\n", ""))
+        self.client.load_repos()
+        resolver.invalidate(["d"])
+        self.assertFalse(resolver.is_installable("e"))
+        self.assertTrue(resolver.is_installable("a"))
+        problems = resolver.explain("e")
+        self.assertEqual([(pkg['package'], map(str, alternatives)) for (pkg, alternatives) in problems],
+                         [("e", ["v"])])
+
+    def test_invalidate_changed_provider(self):
+        resolver = AptRepoResolver(self.client)
+        self.assertTrue(resolver.is_installable("e"))
+        # New version of d still provides v
+        self.write_packages(PACKAGES.replace("Version: 1.0\nArchitecture: amd64\nProvides: v",
+                                             "Version: 2.0\nArchitecture: amd64\nProvides: v"))
+        self.client.load_repos()
+        resolver.invalidate(["d"])
+        (pkgs, unsatisfiable) = resolver.closure(["e"])
+        self.assertEqual(sorted([(pkg['package'], pkg['version']) for pkg in pkgs]),
+                         [("a", "1.0"), ("d", "2.0"), ("e", "1.0")])
+        self.assertEqual(unsatisfiable, [])
+
+    def test_reload(self):
+        resolver = AptRepoResolver(self.client)
+        resolver.closure(["e"])
+        self.write_packages(PACKAGES.replace("Version: 1.0\nArchitecture: amd64\nProvides: v",
+                                             "Version: 2.0\nArchitecture: amd64\nProvides: v"))
+        self.client.load_repos()
+        (pkgs, unsatisfiable) = resolver.closure(["e"])
+        self.assertEqual(sorted([(pkg['package'], pkg['version']) for pkg in pkgs]),
+                         [("a", "1.0"), ("d", "2.0"), ("e", "1.0")])
+        # Only packages currently loaded by client are returned
+        current = []
+        for repo in self.client.binaries:
+            for name in self.client.binaries[repo].keys():
+                current.extend(map(id, self.client.binaries[repo][name]))
+        self.assertEqual([pkg for pkg in pkgs if id(pkg) not in current], [])
+        self.assertEqual(len(resolver._deps), 3)
+
+    def test_multiarch(self):
+        for (arch, text) in MULTIARCH.items():
+            self.write_packages(text, arch)
+        client = AptRepoClient(["deb file://%s stable main" % urllib.pathname2url(self.tmpdir)],
+                               arch = ["amd64", "i386"], use_release = False)
+        client.load_repos()
+        resolver = AptRepoResolver(client)
+        # lib:i386 can't satisfy dependencies of amd64 and (native) all packages
+        self.assertFalse(resolver.is_installable("x"))
+        self.assertFalse(resolver.is_installable("z"))
+        self.assertEqual([(pkg['package'], map(str, alternatives)) for (pkg, alternatives) in resolver.explain("x")],
+                         [("x", ["lib"])])
+        (pkgs, unsatisfiable) = resolver.closure(["y"])
+        self.assertEqual(sorted([pkg['package'] for pkg in pkgs]), ["data", "perl", "tool", "y"])
+        self.assertEqual(unsatisfiable, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import cStringIO, io, os, random, shutil, tempfile, unittest
+
+from minideblib import AptRepoClient as client_module
+from minideblib.DpkgControl import DpkgCompactParagraph, DpkgControl, DpkgParagraph, iter_paragraphs
+
+CONTROL = """Package: a
+Version: 1.0
+
+Package: b
+Version: 2.0
+"""
+
+# Field names of random paragraphs: repeated in different casing
+FIELDS = ["Package", "package", "PACKAGE", "Version", "Depends", "Section", "section", "Description", "X Field"]
+
+
+def random_control(rand):
+    """Returns random control file with comments, repeated fields, continuation 
+    lines and (rarely) lines without colon"""
+    paragraphs = []
+    for i in range(rand.randint(1, 20)):
+        lines = []
+        if rand.random() < 0.1:
+            lines.append("# commentary")
+        lines.append("%s:%s" % (rand.choice(FIELDS[:3]), rand.choice([" a", " b", "c", " c"])))
+        for j in range(rand.randint(0, 6)):
+            choice = rand.random()
+            if choice < 0.05:
+                lines.append("# commentary")
+            elif choice < 0.055:
+                lines.append("no colon")
+            elif choice < 0.3 and len(lines) > 1:
+                lines.append(rand.choice([" continued", "\tcontinued", " ."]))
+            else:
+                lines.append("%s:%s" % (rand.choice(FIELDS), rand.choice(["", " ", " 1.0", "utils", "  two"])))
+        paragraphs.append("\n".join(lines) + "\n")
+    return "".join([para + "\n" * rand.randint(1, 3) for para in paragraphs])
+
+
+
+class DpkgControlTest(unittest.TestCase):
+    def test_unicode(self):
+        para = DpkgParagraph()
+        para.load(io.StringIO(u"Package: a\nSection: utils\n"))
+        self.assertEqual((para["package"], para["section"]), (u"a", u"utils"))
+        control = DpkgControl()
+        control.load(io.StringIO(unicode(CONTROL) + u"Section: utils\n"))
+        self.assertEqual(sorted(control.keys()), [u"a", u"b"])
+        self.assertEqual(control["b"]["section"], u"utils")
+
+
+class ParseTextTest(unittest.TestCase):
+    def setUp(self):
+        self.casing = DpkgParagraph.trueFieldCasing.copy()
+
+    def tearDown(self):
+        DpkgParagraph.trueFieldCasing.clear()
+        DpkgParagraph.trueFieldCasing.update(self.casing)
+
+    def run_parser(self, parse, text, casing):
+        """Returns paragraphs parsed from text, class of raised exception and trueFieldCasing"""
+        DpkgParagraph.trueFieldCasing.clear()
+        DpkgParagraph.trueFieldCasing.update(casing)
+        result = []
+        try:
+            for (keys, values) in parse(text):
+                result.append(zip(keys, values))
+            exc = None
+        except Exception, gene:
+            exc = gene.__class__
+        return (result, exc, DpkgParagraph.trueFieldCasing.copy())
+
+    def test_equivalence(self):
+        # iterParse()/parseText() return the same as repeated calls of parse()
+        rand = random.Random(16)
+        for case_sensitive in (0, 1):
+            key = case_sensitive and "Package" or "package"
+            for fields in (None, set([key, "depends", "Depends", "X Field"])):
+                for func in (None, lambda value: value != "b"):
+                    (parser, bulk) = (DpkgParagraph(), DpkgParagraph())
+                    for para in (parser, bulk):
+                        para.setCaseSensitive(case_sensitive)
+                        para.setFields(fields)
+                        if func:
+                            para.setFilter(key, func)
+                    def parse(text):
+                        # Paragraphs without loaded fields are skipped like by iterParse()
+                        fobj = cStringIO.StringIO(text)
+                        while fobj.tell() < len(text):
+                            (keys, values) = parser.parse(fobj)
+                            if keys:
+                                yield (keys, values)
+                    # Layouts of bulk parser are reused for all texts
+                    for i in range(200):
+                        text = random_control(rand)
+                        casing = dict([(name.lower(), name) for name in rand.sample(FIELDS, 2)])
+                        size = rand.choice([1, 7, 64, 65536])
+                        self.assertEqual(self.run_parser(lambda text: bulk.iterParse(cStringIO.StringIO(text), size),
+                                                         text, casing),
+                                         self.run_parser(parse, text, casing), text)
+
+    def test_no_colon(self):
+        for text in ("Package: a\nno colon\n", "Package: a\n continued\nno colon\n"):
+            self.assertRaises(ValueError, list, DpkgParagraph().iterParse(cStringIO.StringIO(text)))
+            self.assertRaises(ValueError, DpkgParagraph().parse, cStringIO.StringIO(text))
+
+
+class IterParagraphsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "Packages")
+        fobj = open(self.path, "w")
+        fobj.write(CONTROL)
+        fobj.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter(self):
+        paragraphs = list(iter_paragraphs(self.path, compact = 1))
+        self.assertEqual([para.__class__ for para in paragraphs], [DpkgCompactParagraph] * 2)
+        self.assertEqual([(para["package"], para["version"]) for para in paragraphs],
+                         [("a", "1.0"), ("b", "2.0")])
+
+    def test_close(self):
+        opened = []
+        urlopen = client_module._universal_urlopen
+        def spy(*args):
+            opened.append(urlopen(*args))
+            return opened[-1]
+        client_module._universal_urlopen = spy
+        try:
+            paragraphs = iter_paragraphs(self.path)
+            self.assertEqual(paragraphs.next()["package"], "a")
+            paragraphs.close()
+        finally:
+            client_module._universal_urlopen = urlopen
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(opened[0].fileobj.fp, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import cPickle, unittest
+
+from minideblib.DpkgRelation import DpkgRelation, DpkgRelationException, parse_relations
+
+
+def _names(field):
+    """Return names of relations of parsed field grouped by alternatives"""
+    return [[relation.name for relation in group] for group in parse_relations(field)]
+
+
+class DpkgRelationTest(unittest.TestCase):
+    def test_alternatives(self):
+        self.assertEqual(_names("a | b (>= 1), c"), [["a", "b"], ["c"]])
+        self.assertEqual(_names("a|b|c"), [["a", "b", "c"]])
+        self.assertEqual(_names(["a,", " b | c"]), [["a"], ["b", "c"]])
+        self.assertEqual(parse_relations(""), ())
+
+    def test_version(self):
+        ((relation,),) = parse_relations("libc6 (>= 2.31-1)")
+        self.assertEqual(relation.constraint.relation, ">=")
+        self.assertTrue(relation.matches_version("2.31-1"))
+        self.assertTrue(relation.matches_version("2.32"))
+        self.assertFalse(relation.matches_version("2.30"))
+        # Old < and > mean <= and >=
+        ((relation,),) = parse_relations("a(<1.0)")
+        self.assertEqual(relation.constraint.relation, "<=")
+        self.assertTrue(parse_relations("b")[0][0].matches_version("1.0"))
+
+    def test_archqual(self):
+        relations = [group[0] for group in parse_relations("perl:any, gcc:native (>= 4), libc6:amd64, make")]
+        self.assertEqual([relation.archqual for relation in relations], ["any", "native", "amd64", None])
+        self.assertEqual(relations[1].name, "gcc")
+        self.assertEqual(str(relations[1]), "gcc:native (>= 4)")
+
+    def test_arches(self):
+        (linux, other, empty) = [group[0] for group in parse_relations("a [linux-any amd64], b [!i386 !armel], c []")]
+        self.assertEqual(linux.arches, ("linux-any", "amd64"))
+        self.assertTrue(linux.matches_arch("amd64"))
+        self.assertFalse(linux.matches_arch("i386"))
+        self.assertEqual(other.arches, ("!i386", "!armel"))
+        self.assertFalse(other.matches_arch("i386"))
+        self.assertTrue(other.matches_arch("amd64"))
+        self.assertEqual(empty.arches, ())
+        self.assertTrue(empty.matches_arch("i386"))
+
+    def test_profiles(self):
+        ((relation,),) = parse_relations("debhelper (>= 13) [amd64] <!nocheck> <stage1 cross>")
+        self.assertEqual(relation.profiles, (("!nocheck",), ("stage1", "cross")))
+        self.assertEqual(relation.arches, ("amd64",))
+        self.assertEqual(str(relation), "debhelper (>= 13) [amd64] <!nocheck> <stage1 cross>")
+        self.assertEqual(parse_relations("a <>")[0][0].profiles, ((),))
+
+    def test_trailing_comma(self):
+        self.assertEqual(_names("a, b,"), [["a"], ["b"]])
+        self.assertEqual(_names("a,, b , "), [["a"], ["b"]])
+        self.assertEqual(_names(","), [])
+
+    def test_bad_input(self):
+        for field in ("a (>= )", "a (>= 1", "a (== 1)", "a | | b", "a |", ":any", "a:", "a [amd64",
+                      "a <nocheck", "a (>= 1) (<< 2)", "a b", "-a", "a (>= !)"):
+            self.assertRaises(DpkgRelationException, parse_relations, field)
+
+    def test_shared(self):
+        # Equal strings give the same objects, which can be pickled
+        self.assertTrue(parse_relations("a (>= 1), b") is parse_relations("a (>= 1), b"))
+        self.assertTrue(parse_relations("a (>= 1)")[0][0] is parse_relations("c, a (>= 1)")[1][0])
+        relations = parse_relations("a:any (>= 1) [amd64] <!nocheck> | b")
+        self.assertEqual(cPickle.loads(cPickle.dumps(relations, cPickle.HIGHEST_PROTOCOL)), relations)
+        self.assertNotEqual(relations[0][0], DpkgRelation("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
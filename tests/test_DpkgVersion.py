@@ -0,0 +1,92 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import cPickle, random, unittest
+
+from minideblib.DpkgVersion import DpkgVersion, VersionError, deb_cmp, deb_key, \
+     max_version, sort_versions, version_key
+
+# Characters of every class deb_cmp tells apart
+ALPHABET = "019~aZ+.-"
+
+
+def _components(length):
+    """Return all strings of ALPHABET not longer than length"""
+    result = [""]
+    last = [""]
+    for i in range(length):
+        last = [prefix + char for prefix in last for char in ALPHABET]
+        result.extend(last)
+    return result
+
+def _random_version(rnd):
+    """Return random valid version string with optional epoch and revision"""
+    def part(chars, first):
+        return rnd.choice(first) + "".join([rnd.choice(chars) for i in range(rnd.randint(0, 5))])
+    ver = part("0123456789abz.+~", "0123456789")
+    if rnd.random() < 0.5:
+        ver = "%d:%s" % (rnd.randint(0, 2), ver)
+    if rnd.random() < 0.7:
+        ver += "-" + part("0123456789abz.+~", "0123456789abz~")
+    return ver
+
+def _reference_cmp(x, y):
+    """Compare versions with deb_cmp the way it was done before sort keys"""
+    return cmp(x.epoch or 0, y.epoch or 0) or deb_cmp(x.upstream, y.upstream) or \
+           deb_cmp(x.revision or "", y.revision or "")
+
+
+class DpkgVersionTest(unittest.TestCase):
+    def test_components(self):
+        strings = _components(3)
+        keys = [(string, deb_key(string)) for string in strings]
+        for (x, xkey) in keys:
+            for (y, ykey) in keys:
+                if cmp(xkey, ykey) != deb_cmp(x, y):
+                    self.fail("deb_key(%r) and deb_key(%r) don't order like deb_cmp" % (x, y))
+
+    def test_versions(self):
+        rnd = random.Random(1)
+        versions = [DpkgVersion(_random_version(rnd)) for i in range(400)]
+        for x in versions:
+            for y in versions:
+                expected = _reference_cmp(x, y)
+                if cmp(x, y) != expected or cmp(x, str(y)) != expected:
+                    self.fail("%s and %s are compared wrong" % (x, y))
+                if not expected and hash(x) != hash(y):
+                    self.fail("Equal versions %s and %s have different hashes" % (x, y))
+
+    def test_sorting(self):
+        rnd = random.Random(2)
+        strings = [_random_version(rnd) for i in range(200)] + ["bad version"]
+        valid = strings[:-1]
+        expected = [str(ver) for ver in sorted([DpkgVersion(ver) for ver in valid], _reference_cmp)]
+        self.assertEqual([str(DpkgVersion(ver)) for ver in sort_versions(valid)], expected)
+        self.assertEqual([str(DpkgVersion(ver)) for ver in sorted(valid, key = version_key)], expected)
+        invalid = []
+        self.assertEqual(DpkgVersion(max_version(strings, invalid)), DpkgVersion(expected[-1]))
+        self.assertEqual(invalid, ["bad version"])
+
+    def test_parse(self):
+        self.assertEqual(DpkgVersion.parse("1:1.0-1"), DpkgVersion("1:1.0-1"))
+        self.assertTrue(DpkgVersion.parse("1.0-1") is DpkgVersion.parse("1.0-1"))
+        self.assertRaises(VersionError, DpkgVersion.parse, "bad version")
+        self.assertRaises(VersionError, DpkgVersion.parse, "bad version")
+
+    def test_read_only(self):
+        ver = DpkgVersion.parse("1:1.0-1")
+        self.assertRaises(AttributeError, setattr, ver, "epoch", 2)
+        self.assertRaises(AttributeError, setattr, ver, "upstream", "2.0")
+        self.assertRaises(AttributeError, setattr, ver, "revision", None)
+        self.assertEqual((ver.epoch, ver.upstream, ver.revision), (1, "1.0", "1"))
+
+    def test_pickle(self):
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            ver = cPickle.loads(cPickle.dumps(DpkgVersion("1:1.0-1"), protocol))
+            self.assertEqual((ver.epoch, ver.upstream, ver.revision), (1, "1.0", "1"))
+            self.assertEqual(ver, DpkgVersion("1:1.0-1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python -tt
+# -*- coding: UTF-8 -*-
+# vim: sw=4 ts=4 expandtab ai
+
+import BaseHTTPServer, hashlib, os, shutil, tempfile, threading, unittest
+
+from minideblib.AptRepoClient import AptRepoException, _HTTPCache, _universal_urlopen
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves files of server: path -> (body, etag, content length)"""
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        (body, etag, length) = self.server.files[self.path]
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.files = {}
+        self.server.requests = []
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/Packages" % self.server.server_address[1]
+        self.cache = _HTTPCache(self.tmpdir)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def publish(self, body, etag, length = None):
+        if length is None:
+            length = len(body)
+        self.server.files["/Packages"] = (body, etag, length)
+
+    def fetch(self, checksum = None):
+        fobj = _universal_urlopen(self.url, self.tmpdir, checksum)
+        try:
+            # The same way as parser reads indices
+            return "".join(iter(fobj.readline, ""))
+        finally:
+            fobj.close()
+
+    def test_fetch(self):
+        self.publish("original\n", '"1"')
+        self.assertEqual(self.fetch(), "original\n")
+        self.assertEqual(self.cache.get_meta(self.url)["etag"], '"1"')
+        self.assertEqual(self.cache.get_validators(self.url), {'If-None-Match': '"1"'})
+
+    def test_not_modified(self):
+        self.publish("original\n", '"1"')
+        self.fetch()
+        self.assertEqual(self.fetch(), "original\n")
+        self.assertEqual(self.server.requests, [("/Packages", None), ("/Packages", '"1"')])
+
+    def test_changed(self):
+        self.publish("original\n", '"1"')
+        self.fetch()
+        self.publish("changed\n", '"2"')
+        self.assertEqual(self.fetch(), "changed\n")
+        self.assertEqual(self.cache.get_meta(self.url)["etag"], '"2"')
+        # Next request is conditional on the new validator
+        self.assertEqual(self.fetch(), "changed\n")
+        self.assertEqual(self.server.requests[-1], ("/Packages", '"2"'))
+
+    def test_concurrent_cache_dir(self):
+        path = os.path.join(self.tmpdir, "cache")
+        os.mkdir(path)
+        isdir = os.path.isdir
+        # Directory is created by another worker after the check
+        os.path.isdir = lambda name: False
+        try:
+            _HTTPCache(path)
+        finally:
+            os.path.isdir = isdir
+
+    def test_checksum_mismatch(self):
+        self.publish("corrupted\n", '"1"')
+        checksum = ("sha256", hashlib.sha256("original\n").hexdigest(), len("original\n"))
+        self.assertRaises(AptRepoException, self.fetch, checksum)
+        self.assertEqual(self.cache.get_meta(self.url), None)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_checksum_match(self):
+        self.publish("original\n", '"1"')
+        checksum = ("sha256", hashlib.sha256("original\n").hexdigest(), len("original\n"))
+        self.assertEqual(self.fetch(checksum), "original\n")
+        self.assertEqual(self.cache.get_meta(self.url)["etag"], '"1"')
+
+    def test_truncated(self):
+        self.publish("original\n", '"1"', 100)
+        self.fetch()
+        self.assertEqual(self.cache.get_meta(self.url), None)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()